@@ -17,11 +17,14 @@
 # and apply the new model of how DTLOR should work.
 
 # import newickFormatReader
-from Greedy import *
+import Greedy
 import copy
 import sys, glob, os
 import time
+import random
 from random import choice
+from bisect import bisect_right
+import instrument
 
 def valid_star(is_top_star, allsynteny):
     """
@@ -58,59 +61,65 @@ def delta_r(synteny1, synteny2, R):
         return R
 
 Infinity = float('inf')
+# Costs within Epsilon of each other are ties. Mathematically equal costs
+# can be summed in different orders, so exact comparison would drop ties.
+Epsilon = 1e-9
+# Stands for any syntenic location that is absent from the tips of a clade.
+# All such locations are equivalent for the clade, so its tables hold a
+# single entry for them (see clade_entry).
+Other = ("other",)
+
+def iter_preorder(tree, root_edge_name):
+    """
+    Generate the edges of a tree in preorder (high edges to low edges)
+    """
+    stack = [root_edge_name]
+    while stack:
+        edge = stack.pop()
+        yield edge
+        _, _, left_child, right_child = tree[edge]
+        if left_child is not None: # then right_child is not None also
+            stack.append(right_child)
+            stack.append(left_child)
+
+def iter_postorder(tree, root_edge_name):
+    """
+    Generate the edges of a tree in postorder (low edges to high edges)
+    """
+    stack = [(root_edge_name, False)]
+    while stack:
+        edge, expanded = stack.pop()
+        _, _, left_child, right_child = tree[edge]
+        if expanded or left_child is None:
+            yield edge
+        else:
+            stack.append((edge, True))
+            stack.append((right_child, False))
+            stack.append((left_child, False))
 
 def nodes_preorder(tree, root_edge_name):
     """
     Preorder traversal of the /nodes/ of a tree
     """
-    top, bottom, left_child, right_child = tree[root_edge_name]
-    if left_child is None and right_child is None:
-        return [bottom]
-    elif left_child is not None and right_child is not None:
-        return [bottom] + preorder(tree, left_child) + preorder(tree, right_child)
-    else:
-        assert False, "Tree with invalid edge: {}".format(root_edge_name)
+    return [tree[edge][1] for edge in iter_preorder(tree, root_edge_name)]
 
 def nodes_postorder(tree, root_edge_name):
     """
     Postorder traversal of the /nodes/ of a tree
     """
-    top, bottom, left_child, right_child = tree[root_edge_name]
-    if left_child is None and right_child is None:
-        return [bottom]
-    elif left_child is not None and right_child is not None:
-        return preorder(tree, left_child) + preorder(tree, right_child) + [bottom]
-    else:
-        assert False, "Tree with invalid edge: {}".format(root_edge_name)
+    return [tree[edge][1] for edge in iter_postorder(tree, root_edge_name)]
 
 def preorder(tree, rootEdgeName):
     """ Takes a tree as input (see format description above) and returns a 
     list of the edges in that tree in preorder (high edges to low edges)"""
 
-    value = tree[rootEdgeName]
-    _,_,leftChildEdgeName,rightChildEdgeName = value
-
-    # base case
-    if leftChildEdgeName == None: # then rightChildEdgeName == None also
-        return [rootEdgeName]
-    else:
-        return [rootEdgeName] + \
-                preorder(tree, leftChildEdgeName) + \
-                preorder(tree, rightChildEdgeName)
+    return list(iter_preorder(tree, rootEdgeName))
 
 def postorder(tree, rootEdgeName):
     """ Takes a tree as input (see format description above) and returns a 
     list of the edges in that tree in postorder (low edges to high edges)"""
 
-    value = tree[rootEdgeName]
-    _,_,leftChildEdgeName,rightChildEdgeName = value
-    # base case
-    if leftChildEdgeName == None: # then rightChildEdgeName == None also
-        return [rootEdgeName]
-    else:
-        return postorder(tree, leftChildEdgeName) + \
-               postorder(tree, rightChildEdgeName) + \
-               [rootEdgeName]
+    return list(iter_postorder(tree, rootEdgeName))
 
 def check_tip(vh, eh1, eh2):
     if eh1 is None and eh2 is None:
@@ -120,6 +129,147 @@ def check_tip(vh, eh1, eh2):
     else:
         assert False, "Species node with one child: {}".format(vh)
 
+class HostTreeIndex:
+    """
+    Index of a host tree (in the format from trees.parseTreeForDP) that is
+    built once and shared by every DP with that host tree. Host edges get
+    integer ids in postorder, so the children of an edge have smaller ids.
+      tree, root          the host tree and the name of its root edge
+      edges[i]            name of edge i, and index[eh] is the id of eh
+      vertices[i]         name of the host vertex at the bottom of edge i
+      left[i], right[i]   ids of the child edges, -1 if edge i ends in a tip
+      parent[i]           id of the parent edge, -1 for the root
+      is_tip[i]           True if edge i ends in a tip
+      preorder            edge ids in preorder (postorder is range(n))
+      pre_start, pre_end  ancestor intervals: edge j is edge i or below it
+                          iff pre_start[i] <= pre_start[j] < pre_end[i]
+      by_height, by_depth the ids of the internal edges grouped by height
+                          and by depth
+      symbols             optional, whatever the caller used to name the
+                          nodes of host_tree (see familiesDTLORstuff), so
+                          that it is kept with the index. The DP ignores it.
+    """
+    def __init__(self, host_tree, symbols=None):
+        self.tree = host_tree
+        self.symbols = symbols
+        self.root = next(iter(host_tree))
+        self.edges = postorder(host_tree, self.root)
+        self.index = {eh: i for i, eh in enumerate(self.edges)}
+        n = len(self.edges)
+        self.vertices = [host_tree[eh][1] for eh in self.edges]
+        self.left = [-1] * n
+        self.right = [-1] * n
+        self.parent = [-1] * n
+        self.is_tip = [True] * n
+        height = [0] * n
+        size = [1] * n
+        for i, eh in enumerate(self.edges):
+            _, vh, eh1, eh2 = host_tree[eh]
+            if not check_tip(vh, eh1, eh2):
+                l, r = self.index[eh1], self.index[eh2]
+                self.left[i], self.right[i] = l, r
+                self.parent[l] = self.parent[r] = i
+                self.is_tip[i] = False
+                height[i] = 1 + max(height[l], height[r])
+                size[i] = 1 + size[l] + size[r]
+        self.preorder = [self.index[eh] for eh in preorder(host_tree, self.root)]
+        self.pre_start = [0] * n
+        self.pre_end = [0] * n
+        depth = [0] * n
+        for position, i in enumerate(self.preorder):
+            self.pre_start[i] = position
+            self.pre_end[i] = position + size[i]
+            if self.parent[i] != -1:
+                depth[i] = depth[self.parent[i]] + 1
+        internal = [i for i in range(n) if not self.is_tip[i]]
+        self.by_height = [[i for i in internal if height[i] == h] for h in range(1, max(height) + 1)]
+        self.by_depth = [[i for i in internal if depth[i] == d] for d in range(max(depth) + 1)]
+        self.by_depth = [level for level in self.by_depth if level]
+
+    def __len__(self):
+        return len(self.edges)
+
+    def comparable(self, i, j):
+        """
+        True if host edge i is an ancestor or descendant of host edge j, or j.
+        """
+        return self.pre_start[i] <= self.pre_start[j] < self.pre_end[i] or \
+               self.pre_start[j] <= self.pre_start[i] < self.pre_end[j]
+
+    def incomparable(self, i):
+        """
+        The ids of the host edges that are neither ancestors nor descendants
+        of host edge i, i.e. where a transfer from i can go.
+        """
+        return [j for j in range(len(self.edges)) if not self.comparable(i, j)]
+
+def host_tree_index(host_tree):
+    """
+    Returns host_tree as a HostTreeIndex, building one if it is a host tree
+    from trees.parseTreeForDP.
+    """
+    if isinstance(host_tree, HostTreeIndex):
+        return host_tree
+    return HostTreeIndex(host_tree)
+
+def clade_entry(table, eh, l):
+    """
+    Returns the cost in a gene edge's table for (eh, l). Locations that are
+    absent from the clade below the gene edge share the entry for Other.
+    """
+    cost = table.get((eh, l))
+    if cost is None:
+        cost = table[(eh, Other)]
+    return cost
+
+def min_locations(table, eh, loci, absent):
+    """
+    Returns (cost, [locations]) for the cheapest entries of the C table
+    of a gene edge at host edge eh. loci are the locations of the clade
+    and absent are the other locations, which share the entry for Other.
+    """
+    candidates = [(table[(eh, l)], [l]) for l in loci]
+    if absent:
+        candidates.append((table[(eh, Other)], absent))
+    return find_min_events(candidates)
+
+def best_child_cost(table, min_cost, eh, lp, R):
+    """
+    Minimises delta_r(lp, l, R) + table[(eh, l)] over the locations l of a
+    child at host edge eh, given that its parent is at lp. min_cost is the
+    cheapest entry of table at eh. Only l = lp avoids the rearrangement, so
+    the minimum is either the entry for lp or R plus the cheapest entry, which
+    makes this O(1) in the number of locations.
+    """
+    return min(clade_entry(table, eh, lp), R + min_cost)
+
+def best_child_locations(table, eh, lp, R, loci, absent):
+    """
+    Returns (cost, [l]) with the cost of best_child_cost and every location
+    l of the child that attains it.
+    """
+    stay = (clade_entry(table, eh, lp), [lp])
+    min_cost, min_locs = min_locations(table, eh, loci, absent)
+    move = (R + min_cost, [l for l in min_locs if l != lp])
+    cost, locations = find_min_events([stay, move])
+    if cost == Infinity:
+        return (Infinity, [])
+    return (cost, locations)
+
+def cheapest_mappings(table, host_edges, loci, absent):
+    """
+    Returns (cost, [(eh, l)]) for the cheapest non-null entries of the whole
+    C table of a gene edge.
+    """
+    candidates = []
+    for eh in host_edges:
+        c, locs = min_locations(table, eh, loci, absent)
+        candidates.append((c, [(eh, l) for l in locs]))
+    cost, mappings = find_min_events(candidates)
+    if cost == Infinity:
+        return (Infinity, [])
+    return (cost, mappings)
+
 #TODO: rename
 def find_min_events(events_list):
     """
@@ -127,23 +277,21 @@ def find_min_events(events_list):
     Each element of events_list is a tuple of (cost, [events])
     Which holds the DP entry for some part of the DP and the associated events
     This combines them into the entry of lowest cost, combining
-    all events that have lowest cost
+    all events that have lowest cost (up to Epsilon)
     """
     cost = Infinity
     events = []
     for c,e in events_list:
-        if cost > c:
+        if c < cost - Epsilon:
             cost = c
             events = []
-        if cost == c:
+        if c <= cost + Epsilon:
+            cost = min(cost, c)
             events.extend(e)
+    if instrument.recorder is not None:
+        instrument.recorder.count("find_min_events", len(events))
     return (cost, events)
 
-
-#TODO: use this instead of list comprehensions
-# To do this, replace the list comprehensions in the current code with this
-# then use the old find_min_events to combine the output once all the outputs
-# are in the (cost, [event]) form
 def find_min_events_alt(elements, cost_computer, event_computer):
     """
     Faster alternative to find_min_events.
@@ -153,275 +301,635 @@ def find_min_events_alt(elements, cost_computer, event_computer):
     Then cost_computer should be type:
       (species_node, location) -> float
     and event_computer should be type:
-      (species_node, location) -> event
+      (species_node, location) -> [event]
     """
     min_cost = Infinity
+    min_elements = []
+    for element in elements:
+        cost = cost_computer(*element)
+        if cost < min_cost - Epsilon:
+            min_cost = cost
+            min_elements = []
+        if cost <= min_cost + Epsilon:
+            min_cost = min(min_cost, cost)
+            min_elements.append(element)
     min_events = []
-    costs = map(lambda e: cost_computer(*e), elements)
-    for element, cost in zip(elements, costs):
-        if cost < min_cost:
-            min_cost = c
-            min_events = []
-        if cost == min_cost:
-            min_events.extend(event_computer(*element))
+    for element in min_elements:
+        min_events.extend(event_computer(*element))
+    if instrument.recorder is not None:
+        instrument.recorder.count("find_min_events_alt", len(min_events))
     return (min_cost, min_events)
 
-#TODO: optimization where valid returns only the synteny locations for the clade UNDER a given gene node
 #TODO: Refactor other code to reflect the tree representation change:
 # ("C", None, None) versus ("C", (None, None, None, None), (None, None, None, None))
 # and ("L", (...), None) versus ("L", (...), (None, None, None, None)
 
-def DP(host_tree, parasite_tree, phi, locus_map, D, T, L, Origin, R):
+def clade_key(parasite_tree, parasite_root, ep):
+    """
+    Returns the directed edge (neighbour, ep) of the unrooted gene tree that
+    defines the clade below ep. The root is a degree two node that disappears
+    when the tree is unrooted, so the neighbour of either child of the root is
+    the other child.
+    """
+    top = parasite_tree[ep][0]
+    if top == parasite_root:
+        _, _, left, right = parasite_tree[parasite_root]
+        top = right if ep == left else left
+    return (top, ep)
+
+def DP(host_tree, parasite_tree, phi, locus_map, D, T, L, Origin, R, clade_cache=None, track_events=True, cutoff=Infinity, graph=False, clade_done=None):
     """ Takes a host_tree, parasite_tree, tip mapping function phi, a locus_map, 
         and duplication cost (D), transfer cost (T), loss cost (L), 
         origin cost (O) and rearrange cost(R) and returns the an MPR as a dict.
         The notation and dynamic programming algorithm are explained in the tech report.
-        Cospeciation is assumed to cost 0. """
-
-    A = {}  # A, C, O, and best_switch are all defined in tech report
+        Cospeciation is assumed to cost 0.
+        host_tree is either a tree from trees.parseTreeForDP or a
+        HostTreeIndex of one. Passing a HostTreeIndex avoids re-indexing the
+        host tree on every call.
+        clade_cache is an optional dict shared between calls on different rootings
+        of the same unrooted gene tree (with the same host tree, maps and costs).
+        It maps the directed edges of the unrooted gene tree (see clade_key) to the
+        tables of the clade below them, so that a clade shared between rootings
+        is only computed once. clade_done is an optional function that is
+        called with no arguments each time the tables of a clade are added to
+        clade_cache, e.g. to checkpoint them.
+        The tables of a gene edge only cover the syntenic locations of the tips
+        below it, plus one shared entry (Other) for all the other locations.
+        The tables only hold costs. The events of a mapping node are recomputed
+        from the costs (see events below) when the traceback reaches it, so
+        they are only ever built for the nodes of the MPR.
+        If track_events is False, there is no traceback and (None, cost) is
+        returned, e.g. to rank rootings. If graph is True, all the MPRs are
+        returned as an MPRGraph instead of a single MPR.
+        If the cost is more than cutoff, the DP may stop early and return
+        (None, bound), where bound is a lower bound on the cost that is more
+        than cutoff. """
+
+    # A, C, O, and best_switch are all defined in tech report
+    # C, O and best_switch map a gene edge to its table, and each table
+    # maps (eh, lp) to a cost
     C = {}
     O = {}
     best_switch = {}
     # All available syntenic locations
     allsynteny = set(locus_map.values())
-    # Capture R for ease of use - it never changes
-    delta = lambda s1, s2: delta_r(s1, s2, R)
+    # Gene edge -> syntenic locations of the tips below it
+    clade_loci = {}
+    # Gene edge -> locations in its tables
+    clade_domain = {}
     parasite_root = next(iter(parasite_tree))
-    host_root = next(iter(host_tree))
+    host = host_tree_index(host_tree)
+    host_root = host.root
+    host_postorder = host.edges
+    # Gene edge -> cheapest entry of its C table, including the null entry
+    clade_min = {}
+    # Every event costs at least the cheapest entries of its children, so the
+    # cheapest entry of a clade is at least the sum of those of the clades
+    # below it. The cost is then at least the sum over the clades that are
+    # computed but whose parents are not yet.
+    lower_bound = 0
+    def exceeds_cutoff(ep):
+        nonlocal lower_bound
+        _, _, ep1, ep2 = parasite_tree[ep]
+        lower_bound += clade_min[ep]
+        if ep1 is not None:
+            lower_bound -= clade_min[ep1] + clade_min[ep2]
+        return lower_bound > cutoff + Epsilon
+    fill_start = instrument.start()
     #print(host_tree)
     #print("The dimensions is %d by %d by %d by %d"%(len(postorder(parasite_tree, parasite_root)),len(Allsynteny), len(Allsynteny),len(postorder(host_tree, host_root))))
     for ep in postorder(parasite_tree, parasite_root):
+        # Reuse the tables for this clade if another rooting already has them.
+        # The root is never shared, since it adds the origin cost.
+        if clade_cache is not None and ep != parasite_root:
+            key = clade_key(parasite_tree, parasite_root, ep)
+            if key in clade_cache:
+                C[ep], O[ep], best_switch[ep], clade_loci[ep], clade_domain[ep], clade_min[ep] = clade_cache[key]
+                if exceeds_cutoff(ep):
+                    instrument.stop("dp fill", fill_start)
+                    return None, lower_bound
+                continue
         _,vp,ep1,ep2 = parasite_tree[ep]
         vp_is_a_tip = check_tip(vp, ep1, ep2)
-        for lp in allsynteny:  # The location of ep at the bottom of the branch above ep
-            for eh in postorder(host_tree, host_root):
+        if vp_is_a_tip:
+            loci_ep = [locus_map[vp]]
+        else:
+            below = set(clade_loci[ep1]) | set(clade_loci[ep2])
+            loci_ep = [l for l in allsynteny if l in below]
+        clade_loci[ep] = loci_ep
+        # Only the locations below ep can matter, plus one entry for the rest
+        if len(loci_ep) < len(allsynteny):
+            domain_ep = loci_ep + [Other]
+        else:
+            domain_ep = loci_ep
+        clade_domain[ep] = domain_ep
+        C_ep = C[ep] = {}
+        O_ep = O[ep] = {}
+        switch_ep = best_switch[ep] = {}
+        if not vp_is_a_tip:
+            C_ep1, C_ep2 = C[ep1], C[ep2]
+            switch_ep1, switch_ep2 = best_switch[ep1], best_switch[ep2]
+            # Cheapest entry of each child at each host edge
+            mins_ep1 = {eh: min(C_ep1[(eh, l)] for l in clade_domain[ep1]) for eh in host_postorder}
+            mins_ep2 = {eh: min(C_ep2[(eh, l)] for l in clade_domain[ep2]) for eh in host_postorder}
+            # The children's locations are not charged for a duplication, so
+            # its cost does not depend on lp and each child takes its cheapest
+            # locations independently
+            duplications_ep = {eh: mins_ep1[eh] + mins_ep2[eh] + D for eh in host_postorder}
+        for lp in domain_ep:  # The location of ep at the bottom of the branch above ep
+            for i, eh in enumerate(host_postorder):
                 #print(ep, lp, eh)
-                _,vh,eh1,eh2 = host_tree[eh]
-                vh_is_a_tip = check_tip(vh, eh1, eh2)
+                vh = host.vertices[i]
+                vh_is_a_tip = host.is_tip[i]
+                if not vh_is_a_tip:
+                    eh1, eh2 = host_postorder[host.left[i]], host_postorder[host.right[i]]
                 # Compute A[(ep, eh, lp)]
                 if vh_is_a_tip:
                     if vp_is_a_tip and phi[vp] == vh and locus_map[vp]==lp:
-                        A[(ep, eh, lp)] = (0, [("C", None, None)])
+                        A = 0
                     else: 
-                        A[(ep, eh, lp)] = (Infinity, [])
+                        A = Infinity
                 else: # vh is not a tip
                     # Compute cospeciation events
                     if not vp_is_a_tip:
-                        def get_cospeciations(l1, l2):
-                            synteny_cost = delta(lp, l1) + delta(lp, l2)
-                            co1 = (synteny_cost + C[(ep1, eh1, l1)][0] + C[(ep2, eh2, l2)][0], \
-                                    [("S", (ep1, eh1, l1), (ep2, eh2, l2))])
-                            co2 = (synteny_cost + C[(ep1, eh2, l1)][0] + C[(ep2, eh1, l2)][0], \
-                                    [("S", (ep1, eh2, l1), (ep2, eh1, l2))])
-                            return find_min_events([co1, co2])
-                        cospeciation_list = [get_cospeciations(l1, l2) for l1 in allsynteny for l2 in allsynteny]
-                        cospeciations = find_min_events(cospeciation_list)
+                        # The synteny cost splits into one term per child, so each
+                        # child takes its own cheapest location
+                        cospeciations = min(
+                                best_child_cost(C_ep1, mins_ep1[eh1], eh1, lp, R) + \
+                                best_child_cost(C_ep2, mins_ep2[eh2], eh2, lp, R),
+                                best_child_cost(C_ep1, mins_ep1[eh2], eh2, lp, R) + \
+                                best_child_cost(C_ep2, mins_ep2[eh1], eh1, lp, R))
                     else:
-                        cospeciations = (Infinity, [])
+                        cospeciations = Infinity
                     # Compute loss events
                     # eh1 is the branch where ep is lost
-                    loss_eh1 = (C[(ep, eh2, lp)][0] + L, [("L", (vp, eh2, lp), None)])
+                    loss_eh1 = C_ep[(eh2, lp)] + L
                     # eh2 is the branch where ep is lost
-                    loss_eh2 = (C[(ep, eh1, lp)][0] + L, [("L", (vp, eh1, lp), None)])
-                    losses = find_min_events([loss_eh1, loss_eh2])
-
-                    # Determine which event occurs for A[(ep, eh, lp)]
-                    A[(ep, eh, lp)] = find_min_events([cospeciations, losses])
+                    loss_eh2 = C_ep[(eh1, lp)] + L
+                    A = min(cospeciations, loss_eh1, loss_eh2)
 
                 # Compute C[(ep, eh,l_top, lp)]
-                # First, compute duplications
-                if not vp_is_a_tip:
-                    DUPepeh=Infinity
-                    # List to keep track of lowest cost duplication event
-                    dupList=[Infinity]
-                    def get_duplication(l1, l2):
-                        synteny_cost = delta(lp, l1) + delta(lp, l2)
-                        dup_cost = C[(ep1, eh, l1)][0] + C[(ep2, eh, l2)][0] + D
-                        dup_event = ("D", (ep1, vh, l1), (ep2, vh, l2))
-                        return (dup_cost, [dup_event])
-                    dup_list = [get_duplication(l1, l2) for l1 in allsynteny for l2 in allsynteny]
-                    duplications = find_min_events(dup_list)
-                else:
-                    duplications = (Infinity, [])
-               
-                # Compute transfer table
                 if not vp_is_a_tip:
+                    # First, compute duplications
+                    duplications = duplications_ep[eh]
                     #TODO: the transferred child keeps the same synteny?
-                    # Over all possible children syntenies
-                    def get_transfer(new_l):
-                        synteny_cost = delta(lp, new_l)
-                        # Cost to transfer ep2
-                        # Transferred child (ep2) keeps the same syntenic location (lp)
-                        ep2_cost, ep2_locations = best_switch[(ep2, eh, lp)]
-                        ep2_switch_cost = T + synteny_cost + C[(ep1, eh, new_l)][0] + ep2_cost
-                        ep2_switch_events = [("T", (ep1, vh, new_l), (ep2, location[1], lp)) for location in \
-                                ep2_locations]
-                        ep2_switch = (ep2_switch_cost, ep2_switch_events)
-                        # Cost to transfer ep1
-                        # Now ep1 is being transferred and keeps lp
-                        ep1_cost, ep1_locations = best_switch[(ep1, eh, lp)]
-                        ep1_switch_cost = T + synteny_cost + C[(ep2, eh, new_l)][0] + ep1_cost
-                        ep1_switch_events = [("T", (ep2, vh, new_l), (ep1, location[1], lp)) for location in \
-                                ep1_locations]
-                        ep1_switch = (ep1_switch_cost, ep1_switch_events)
-                        return find_min_events([ep2_switch, ep1_switch])
-                    transfer_list = [get_transfer(l1) for l1 in allsynteny]
-                    transfers = find_min_events(transfer_list)
+                    # The child that is not transferred takes its cheapest location
+                    # Cost to transfer ep2
+                    # Transferred child (ep2) keeps the same syntenic location (lp)
+                    ep2_switch = T + best_child_cost(C_ep1, mins_ep1[eh], eh, lp, R) + \
+                            clade_entry(switch_ep2, eh, lp)
+                    # Cost to transfer ep1
+                    # Now ep1 is being transferred and keeps lp
+                    ep1_switch = T + best_child_cost(C_ep2, mins_ep2[eh], eh, lp, R) + \
+                            clade_entry(switch_ep1, eh, lp)
+                    transfers = min(ep2_switch, ep1_switch)
                 else:
-                    transfers = (Infinity, [])
+                    duplications = Infinity
+                    transfers = Infinity
 
-                # Compute C[(ep, eh, l_top, lp)] and the associated events
-                C[(ep, eh, lp)] = \
-                        find_min_events([A[(ep, eh, lp)], duplications, transfers])
+                C_ep[(eh, lp)] = min(A, duplications, transfers)
                 # The root must factor in the cost of getting a syntenic location
                 if ep == parasite_root:
-                    old = C[(ep, eh, lp)]
-                    C[(ep, eh, lp)] = (old[0] + Origin, old[1])
+                    C_ep[(eh, lp)] += Origin
 
-                # Compute O[(ep, eh, lp)]
-                # O is mapping_node -> (cost, [mapping_node])
+                # Compute O[(ep, eh, lp)], the best C in the host subtree of eh
                 if vh_is_a_tip: 
-                    O[(ep, eh, lp)] = (C[(ep, eh, lp)][0], [(vp, vh, lp)])
+                    O_ep[(eh, lp)] = C_ep[(eh, lp)]
                 else: 
-                    O_c = (C[(ep, eh, lp)][0], [(vp, vh, lp)])
-                    O_eh1 = (O[(ep, eh1, lp)])
-                    O_eh2 = (O[(ep, eh2, lp)])
-                    O[(ep, eh, lp)] = find_min_events([O_c, O_eh1, O_eh2])
+                    O_ep[(eh, lp)] = min(C_ep[(eh, lp)], O_ep[(eh1, lp)], O_ep[(eh2, lp)])
 
             # Compute best_switch values for the children
-            best_switch[(ep, host_root, lp)] = (Infinity, [])
-            for eh in preorder(host_tree, host_root):
-                _, vh, eh1, eh2 = host_tree[eh]
-                # Find the best switches and switch locations for the children of vh
+            switch_ep[(host_root, lp)] = Infinity
+            for i in host.preorder:
+                # Find the best switches for the children of vh
                 # Don't set best_switch for nonexistent children
-                if not check_tip(vh, eh1, eh2):
-                    ep_best_switch = best_switch[(ep, eh, lp)]
-                    O_eh2=O[(ep, eh2, lp)]
-                    O_eh1=O[(ep, eh1, lp)]
-                    best_switch[(ep, eh1, lp)] = find_min_events([ep_best_switch, O_eh2])
-                    best_switch[(ep, eh2, lp)] = find_min_events([ep_best_switch, O_eh1])
+                if not host.is_tip[i]:
+                    eh, eh1, eh2 = host_postorder[i], host_postorder[host.left[i]], host_postorder[host.right[i]]
+                    ep_best_switch = switch_ep[(eh, lp)]
+                    switch_ep[(eh1, lp)] = min(ep_best_switch, O_ep[(eh2, lp)])
+                    switch_ep[(eh2, lp)] = min(ep_best_switch, O_ep[(eh1, lp)])
         # Compute the cost of not giving a syntenic location
+        null_start = instrument.start()
         # Tip must have a syntenic location
         if vp_is_a_tip:
-            C[(vp, host_root, "*")] = (Infinity, [])
+            C_ep[(host_root, "*")] = Infinity
         else:
-            def get_single_null(eh, l):
-                # Left child stays null
-                l_map = (ep1, host_root, "*")
-                r_map = (ep2, eh, l)
-                left_null_cost = C[l_map][0] + C[r_map][0] + Origin
-                left_null_event = ("N", l_map, r_map)
-                left_null = (left_null_cost, [left_null_event])
-                # Right child stays null
-                l_map = (ep1, eh, l)
-                r_map = (ep2, host_root, "*")
-                right_null_cost = C[l_map][0] + C[r_map][0] + Origin
-                right_null_event = ("N", l_map, r_map)
-                right_null = (right_null_cost, [right_null_event])
-                return find_min_events([left_null, right_null])
-            single_null_list = [get_single_null(eh, l) \
-                    for eh in postorder(host_tree, host_root) for l in allsynteny]
-            single_null = find_min_events(single_null_list)
-
-            # Neither child gets a synteny
-            l_map = (ep1, host_root, "*")
-            r_map = (ep2, host_root, "*")
-            both_null_cost = C[l_map][0] + C[r_map][0]
-            both_null_event = ("N", l_map, r_map)
-            both_null = (both_null_cost, [both_null_event])
-
-            def get_neither_child_null(eh1, l1, eh2, l2):
-                l_map = (ep1, eh1, l1)
-                r_map = (ep2, eh2, l2)
-                neither_null_cost = C[l_map][0] + C[r_map][0] + 2 * Origin
-                neither_null_event = ("N", l_map, r_map)
-                return (neither_null_cost, [neither_null_event])
-
-            neither_null_list = [get_neither_child_null(eh1, l1, eh2, l2) \
-                    for eh1 in postorder(host_tree, host_root) for eh2 in postorder(host_tree, host_root) \
-                    for l1 in allsynteny for l2 in allsynteny]
-            neither_null = find_min_events(neither_null_list)
-
-            C[(ep, host_root, "*")] = find_min_events([single_null, both_null, neither_null])
+            # A child that is not null contributes the same cost wherever it
+            # is mapped, so only its cheapest mappings over all (eh, l) matter
+            min1 = min(mins_ep1.values())
+            min2 = min(mins_ep2.values())
+            null1 = C_ep1[(host_root, "*")]
+            null2 = C_ep2[(host_root, "*")]
+            # One child stays null, neither child gets a synteny, or both do
+            C_ep[(host_root, "*")] = min(null1 + min2 + Origin, min1 + null2 + Origin, \
+                    null1 + null2, min1 + min2 + 2 * Origin)
+        null_seconds = instrument.stop("null step", null_start)
+        if null_seconds is not None:
+            # The null step is its own phase, not part of "dp fill"
+            fill_start += null_seconds
+        if instrument.recorder is not None:
+            instrument.recorder.cells += len(C_ep)
+
+        clade_min[ep] = min(C_ep.values())
+        if clade_cache is not None and ep != parasite_root:
+            clade_cache[key] = (C_ep, O_ep, switch_ep, loci_ep, domain_ep, clade_min[ep])
+            if clade_done is not None:
+                clade_done()
+        if exceeds_cutoff(ep):
+            instrument.stop("dp fill", fill_start)
+            return None, lower_bound
 
     # Cost for assigning the root a syntenic location
-    root_not_null_list = [C[(parasite_root, eh, l)] for eh in postorder(host_tree, host_root) for l in allsynteny]
+    C_root = C[parasite_root]
+    # Locations in locus_map that no tip of the tree has share the entry for
+    # Other, as they do in every other table
+    root_not_null_list = [C_root[(eh, l)] for eh in host_postorder for l in clade_domain[parasite_root]]
     # Cost for not assigning a syntenic location
-    root_null = C[(parasite_root, host_root, "*")]
-    root_list = root_not_null_list + [root_null]
-    min_cost, _ = find_min_events(root_list)
+    root_null = C_root[(host_root, "*")]
+    min_cost = min(root_not_null_list + [root_null])
+    instrument.stop("dp fill", fill_start)
+    if not track_events:
+        return None, min_cost
+
+    def absent_loci(ep):
+        loci_ep = set(clade_loci[ep])
+        return [l for l in allsynteny if l not in loci_ep]
+
+    def child_locations(ep, eh, lp):
+        return best_child_locations(C[ep], eh, lp, R, clade_loci[ep], absent_loci(ep))
+
+    def switch_locations(ep, eh, lp, cost):
+        """
+        The host vertices below the host edges that are neither ancestors nor
+        descendants of eh where ep has cost, i.e. the transfer destinations
+        that attain clade_entry(best_switch[ep], eh, lp).
+        """
+        return [host.vertices[j] for j in host.incomparable(host.index[eh]) \
+                if clade_entry(C[ep], host.edges[j], lp) <= cost + Epsilon]
+
+    def events(mapping):
+        """
+        Recompute the events of minimum cost for a mapping node from the
+        cost tables, in the same way that its cost was computed.
+        """
+        ep, eh, lp = mapping
+        _, vp, ep1, ep2 = parasite_tree[ep]
+        if lp == "*":
+            return null_events(ep, ep1, ep2)
+        _, vh, eh1, eh2 = host.tree[eh]
+        # Each element is an event type with the host edges or gene edges it
+        # involves. Only the elements of minimum cost are expanded to events.
+        elements = []
+        if eh1 is None:
+            if ep1 is None and phi[vp] == vh and locus_map[vp] == lp:
+                elements.append(("C", None, None))
+        else:
+            if ep1 is not None:
+                elements.extend([("S", eh1, eh2), ("S", eh2, eh1)])
+            elements.extend([("L", eh2, None), ("L", eh1, None)])
+        if ep1 is not None:
+            elements.extend([("D", None, None), ("T", ep1, ep2), ("T", ep2, ep1)])
+
+        def cost_computer(e_type, a, b):
+            if e_type == "C":
+                return 0
+            elif e_type == "S":
+                return child_locations(ep1, a, lp)[0] + child_locations(ep2, b, lp)[0]
+            elif e_type == "L":
+                return clade_entry(C[ep], a, lp) + L
+            elif e_type == "D":
+                return min_locations(C[ep1], eh, clade_loci[ep1], absent_loci(ep1))[0] + \
+                        min_locations(C[ep2], eh, clade_loci[ep2], absent_loci(ep2))[0] + D
+            else: # a is kept, b is transferred
+                return T + child_locations(a, eh, lp)[0] + clade_entry(best_switch[b], eh, lp)
+
+        def event_computer(e_type, a, b):
+            if e_type == "C":
+                return [("C", None, None)]
+            elif e_type == "S":
+                _, locs1 = child_locations(ep1, a, lp)
+                _, locs2 = child_locations(ep2, b, lp)
+                return [("S", (ep1, a, l1), (ep2, b, l2)) for l1 in locs1 for l2 in locs2]
+            elif e_type == "L":
+                return [("L", (vp, a, lp), None)]
+            elif e_type == "D":
+                _, locs1 = min_locations(C[ep1], eh, clade_loci[ep1], absent_loci(ep1))
+                _, locs2 = min_locations(C[ep2], eh, clade_loci[ep2], absent_loci(ep2))
+                return [("D", (ep1, eh, l1), (ep2, eh, l2)) for l1 in locs1 for l2 in locs2]
+            else:
+                _, new_locs = child_locations(a, eh, lp)
+                locations = switch_locations(b, eh, lp, clade_entry(best_switch[b], eh, lp))
+                return [("T", (a, vh, new_l), (b, location, lp)) \
+                        for new_l in new_locs for location in locations]
+
+        cost, found = find_min_events_alt(elements, cost_computer, event_computer)
+        if cost == Infinity:
+            return []
+        return found
+
+    def null_events(ep, ep1, ep2):
+        # Tip must have a syntenic location
+        if ep1 is None:
+            return []
+        min1, min_maps1 = cheapest_mappings(C[ep1], host_postorder, clade_loci[ep1], absent_loci(ep1))
+        min2, min_maps2 = cheapest_mappings(C[ep2], host_postorder, clade_loci[ep2], absent_loci(ep2))
+        null1 = C[ep1][(host_root, "*")]
+        null2 = C[ep2][(host_root, "*")]
+        l_map = (ep1, host_root, "*")
+        r_map = (ep2, host_root, "*")
+        candidates = [
+                # Left child stays null
+                (null1 + min2 + Origin, [("N", l_map, (ep2, eh, l)) for eh, l in min_maps2]),
+                # Right child stays null
+                (min1 + null2 + Origin, [("N", (ep1, eh, l), r_map) for eh, l in min_maps1]),
+                # Neither child gets a synteny
+                (null1 + null2, [("N", l_map, r_map)]),
+                # Both children get a synteny, each at one of its cheapest mappings
+                (min1 + min2 + 2 * Origin, [("N", (ep1, eh1, l1), (ep2, eh2, l2)) \
+                        for eh1, l1 in min_maps1 for eh2, l2 in min_maps2])]
+        cost, found = find_min_events(candidates)
+        if cost == Infinity:
+            return []
+        return found
+
+    # Find the mapping nodes involving the root of minimum cost, with the
+    # entry for Other standing for each location that is absent from the tree
+    best_roots = []
+    for (eh, l), c in C_root.items():
+        if c <= min_cost + Epsilon:
+            if l == Other:
+                best_roots.extend((parasite_root, eh, absent) for absent in absent_loci(parasite_root))
+            else:
+                best_roots.append((parasite_root, eh, l))
+
+    with instrument.timed("traceback"):
+        if graph:
+            return MPRGraph(best_roots, MPR_graph(best_roots, events)), min_cost
+        # This picks a random MPR from the optimal ones
+        MPR = find_MPR(best_roots, events)
+    return MPR, min_cost
 
-    # Find the mapping nodes involving the root of minimum cost
-    best_roots = [m for m,c in C.items() if m[0] == parasite_root and c[0] == min_cost]
+def find_MPR(best_roots, events):
+    """
+    Find a single MPR from best_roots, where events gives the events of
+    minimum cost for a mapping node.
+    """
+    return find_MPR_helper(best_roots, events, {})
 
-    # This picks a random MPR from the optimal ones
-    MPR = find_MPR(best_roots, C)
-    #G = MPR_graph(best_roots, C)
-    return MPR, min_cost
+def find_MPR_helper(nodes, events, MPR):
+    """
+    Find a single MPR using events. Does the work for find_MPR.
+    """
+    # The left child of an event is pushed last, so the mapping nodes are
+    # visited in preorder
+    stack = [choice(nodes)]
+    while stack:
+        mapping = stack.pop()
+        mapping_events = events(mapping)
+        if instrument.recorder is not None:
+            instrument.recorder.count("events", len(mapping_events))
+        event = choice(mapping_events)
+        MPR[mapping] = event
+        e_type, e_left, e_right = event
+        if e_right is not None:
+            stack.append(e_right)
+        if e_left is not None:
+            stack.append(e_left)
+    return MPR
 
-def find_MPR(best_roots, C):
+def MPR_graph(best_roots, events):
     """
-    Find a single MPR for the given C dict and best_roots.
+    Find the MPR graph for the given events function and best_roots. The
+    graph maps each mapping node that is in some MPR to its events of
+    minimum cost. A mapping node can be reached from many events, but it
+    is expanded only once, so the graph is built in time linear in its size.
     """
-    return find_MPR_helper(best_roots, C, {})
+    G = {}
+    stack = list(best_roots)
+    while stack:
+        mapping = stack.pop()
+        if mapping in G:
+            continue
+        mapping_events = events(mapping)
+        if instrument.recorder is not None:
+            instrument.recorder.count("events", len(mapping_events))
+        G[mapping] = mapping_events
+        for e_type, e_left, e_right in mapping_events:
+            if e_left is not None and e_left not in G:
+                stack.append(e_left)
+            if e_right is not None and e_right not in G:
+                stack.append(e_right)
+    return G
 
-def find_MPR_helper(nodes, C, MPR):
+def graph_postorder(G, roots):
+    """
+    The mapping nodes of the MPR graph G reachable from roots, each once,
+    ordered so that the children of every event come before the mapping
+    node it belongs to.
     """
-    Recursively find a single MPR using C. Does the work for find_MPR.
+    order = []
+    visited = set()
+    # a mapping node is pushed again with expanded True once its children
+    # are pushed, and added to order when that entry is popped
+    stack = [(mapping, False) for mapping in roots]
+    while stack:
+        mapping, expanded = stack.pop()
+        if expanded:
+            order.append(mapping)
+            continue
+        if mapping in visited:
+            continue
+        visited.add(mapping)
+        stack.append((mapping, True))
+        for e_type, e_left, e_right in G[mapping]:
+            if e_left is not None and e_left not in visited:
+                stack.append((e_left, False))
+            if e_right is not None and e_right not in visited:
+                stack.append((e_right, False))
+    return order
+
+def event_count(event, counts, event_weight=None):
+    """
+    The number of MPRs of the subtree below an event, given the counts of
+    the mapping nodes below it (see MPR_counts), each weighted by
+    event_weight(event) if given.
     """
-    mapping = choice(nodes)
-    event = choice(C[mapping][1])
-    MPR[mapping] = event
     e_type, e_left, e_right = event
+    n = 1 if event_weight is None else event_weight(event)
     if e_left is not None:
-        _ = find_MPR_helper([e_left], C, MPR)
+        n *= counts[e_left]
     if e_right is not None:
-        _ = find_MPR_helper([e_right], C, MPR)
-    return MPR
+        n *= counts[e_right]
+    return n
 
-def MPR_graph(best_roots, C):
+def MPR_counts(G, roots, event_weight=None):
     """
-    Find the MPR graph for a given C dict and best_roots.
+    For each mapping node of the MPR graph G, the number of MPRs of the
+    gene subtree below it that map it there. These are Python ints, so
+    they are exact however many MPRs there are. If event_weight is given,
+    each MPR counts as the product of event_weight over its events instead
+    of 1.
     """
-    return MPR_graph_helper(best_roots, C, {})
+    counts = {}
+    for mapping in graph_postorder(G, roots):
+        counts[mapping] = sum(event_count(event, counts, event_weight) for event in G[mapping])
+    return counts
 
-def MPR_graph_helper(nodes, C, G):
+def MPR_outside_counts(G, roots, counts):
     """
-    Recursively create the entire MPR graph. Does the work for MPR_graph.
+    For each mapping node of the MPR graph G, the number of ways to
+    complete an MPR above it: the number of MPRs that use it is its
+    outside count times its count from MPR_counts. Together these are the
+    inside/outside counts of the graph, computed in time linear in its size.
     """
-    for mapping in nodes:
-        events = C[mapping][1]
-        G[mapping] = events
-        for e_type, e_left, e_right in events:
+    order = graph_postorder(G, roots)
+    outside = dict.fromkeys(order, 0)
+    for mapping in roots:
+        outside[mapping] += 1
+    # Parents before children, so a mapping node's outside count is
+    # complete before it is passed down
+    for mapping in reversed(order):
+        out = outside[mapping]
+        if out == 0:
+            continue
+        for e_type, e_left, e_right in G[mapping]:
             if e_left is not None:
-                MPR_graph_helper([e_left], C, G)
+                outside[e_left] += out * (1 if e_right is None else counts[e_right])
             if e_right is not None:
-                MPR_graph_helper([e_right], C, G)
-    return G
+                outside[e_right] += out * (1 if e_left is None else counts[e_left])
+    return outside
+
+class MPRGraph:
+    """
+    All the MPRs of a DP, as returned by DP with graph=True. roots are the
+    mapping nodes of the gene tree root with minimum cost, and graph is
+    the MPR graph from MPR_graph.
+    """
+
+    def __init__(self, roots, graph):
+        self.roots = roots
+        self.graph = graph
+        self._counts = None
+        self._outside = None
+
+    def __len__(self):
+        return len(self.graph)
+
+    def counts(self):
+        """
+        The number of MPRs below each mapping node (see MPR_counts).
+        """
+        if self._counts is None:
+            self._counts = MPR_counts(self.graph, self.roots)
+        return self._counts
+
+    def count(self):
+        """
+        The number of MPRs, counted in time linear in the size of the graph.
+        """
+        counts = self.counts()
+        return sum(counts[mapping] for mapping in self.roots)
+
+    def outside_counts(self):
+        """
+        The number of ways to complete an MPR above each mapping node (see
+        MPR_outside_counts).
+        """
+        if self._outside is None:
+            self._outside = MPR_outside_counts(self.graph, self.roots, self.counts())
+        return self._outside
+
+    def mapping_support(self):
+        """
+        The fraction of all the MPRs that use each mapping node.
+        """
+        counts, outside, total = self.counts(), self.outside_counts(), self.count()
+        return {mapping: outside[mapping] * counts[mapping] / total for mapping in self.graph}
+
+    def event_support(self):
+        """
+        The fraction of all the MPRs that use each event, as a dict from
+        (mapping node, event) to its fraction. This is computed exactly in
+        one inside/outside pass over the graph, in time linear in its size.
+        """
+        counts, outside, total = self.counts(), self.outside_counts(), self.count()
+        support = {}
+        for mapping, events in self.graph.items():
+            for event in events:
+                support[(mapping, event)] = outside[mapping] * event_count(event, counts) / total
+        return support
+
+    def sample(self, k=1, seed=None, event_weight=None):
+        """
+        Draw k MPRs uniformly at random, each as a dict from mapping node to
+        event like the MPR from find_MPR. The MPR counts below each mapping
+        node are computed once and shared by all the samples, so each
+        sample takes time linear in the size of the MPR. If event_weight is
+        given, an MPR is drawn with probability proportional to the product
+        of event_weight over its events, and a ValueError is raised if every
+        MPR has weight 0. seed makes the samples reproducible.
+        """
+        rng = random.Random(seed)
+        if event_weight is None:
+            counts = self.counts()
+        else:
+            counts = MPR_counts(self.graph, self.roots, event_weight)
+
+        # mapping node -> (events, cumulative counts of its events)
+        cumulative = {}
+        def cumulate(choices, weights):
+            cumulative_weights = []
+            total = 0
+            for weight in weights:
+                total += weight
+                cumulative_weights.append(total)
+            return choices, cumulative_weights
+        def pick(choices, cumulative_weights):
+            total = cumulative_weights[-1]
+            # exact for ints, so that huge counts are still uniform
+            if isinstance(total, int):
+                x = rng.randrange(total)
+            else:
+                x = rng.random() * total
+            return choices[min(bisect_right(cumulative_weights, x), len(choices) - 1)]
+
+        roots = cumulate(self.roots, [counts[mapping] for mapping in self.roots])
+        if not roots[1][-1] > 0:
+            raise ValueError("event_weight gives every MPR a weight of 0, so there is no MPR to sample")
+        samples = []
+        for i in range(k):
+            MPR = {}
+            stack = [pick(*roots)]
+            while stack:
+                mapping = stack.pop()
+                if mapping not in cumulative:
+                    events = self.graph[mapping]
+                    cumulative[mapping] = cumulate(events, [event_count(event, counts, event_weight) for event in events])
+                event = pick(*cumulative[mapping])
+                MPR[mapping] = event
+                e_type, e_left, e_right = event
+                if e_left is not None:
+                    stack.append(e_left)
+                if e_right is not None:
+                    stack.append(e_right)
+            samples.append(MPR)
+        return samples
 
 def preorderDTLORsort(DTLOR, ParasiteRoot):
     """This takes in a DTL reconciliation graph and parasite root and returns 
-    a sorted list, orderedKeysL, that is ordered by level from largest to 
-    smallest, where level 0 is the root and the highest level has tips."""
-
-    keysL = orderDTLOR(DTLOR, ParasiteRoot)
-    uniqueKeysL = sortHelper(DTLOR, keysL)
-    orderedKeysL = []
-    levelCounter = 0
-    while len(orderedKeysL) < len(keysL):
-        for mapping in keysL:
-            if mapping[-1] == levelCounter:
-                orderedKeysL = orderedKeysL + [mapping]
-        levelCounter += 1
-    
-    # lastLevel = orderedKeysL[-1][1]
-    return orderedKeysL
+    a sorted list, orderedKeysL, that is ordered by level from smallest to 
+    largest, where level 0 is the root and the highest level has tips."""
+
+    return Greedy.levelSort(DTLOR, ParasiteRoot)
 
 def addScores(treeMin, DTLORDict, ScoreDict):
     """Takes the list of reconciliation roots, the DTLOR reconciliation graph, 
     a dictionary of parent nodes, and a dictionary of score values, and 
     returns the DTLOR with the normalized frequency scores calculated."""
-    newDTLOR = copy.deepcopy(DTLORDict)
+    # The events are lists of a type, children and a score, so copying them
+    # is enough to change the scores
+    newDTLOR = {key: [list(event) for event in DTLORDict[key][:-1]] + [DTLORDict[key][-1]] \
+                for key in DTLORDict}
     parentsDict = {}
     ParasiteRoot=treeMin[0][0]
     preOrder = preorderDTLORsort(DTLORDict, ParasiteRoot)
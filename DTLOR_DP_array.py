@@ -0,0 +1,304 @@
+# DTLOR_DP_array.py
+# Array-backed engine for the DTLOR dynamic program in DTLOR_DP.py
+
+# Computes the same tables as DTLOR_DP.DP, but gene edges, host edges and
+# loci are integer-indexed and the C, O and best_switch tables of each gene
+# edge are dense NumPy arrays indexed by [host edge, locus]. Each table is
+# filled with vectorized operations over loci, and over all the host edges
+# at the same height of the host tree. No events are stored during the fill:
+# the events of a mapping node are recovered from the cost tables only when
+# the traceback visits it.
+
+# Because the costs are summed in a different order than in DTLOR_DP.DP,
+# costs are compared with a tolerance of Epsilon when recovering events.
+
+import numpy as np
+from DTLOR_DP import postorder, clade_key, find_MPR, MPR_graph, MPRGraph, host_tree_index, Infinity, Epsilon
+import instrument
+
+def switch_minimum(C, R):
+    """
+    For every [..., eh, lp] returns min over l of delta_r(lp, l, R) + C[..., eh, l],
+    the cheapest way for a child at host edge eh to take a syntenic location
+    given that its parent has location lp.
+    """
+    return np.minimum(C, R + C.min(axis=-1, keepdims=True))
+
+def fill_tables(host, parasite_tree, phi, locus_map, loci, costs, clade_cache=None, cutoff=None, clade_done=None):
+    """
+    Fills the tables of the DP for P cost vectors at once. costs is a [P, 5]
+    array with a row (D, T, L, Origin, R) for each cost vector, and each
+    table has a leading axis over the cost vectors: C and best_switch are
+    [P, host edge, locus] and null is [P]. The host edges are indexed as in
+    host, a HostTreeIndex, and the loci as in loci. cutoff is an optional
+    [P] array, and the DP stops early once the lower bound on the cost
+    (as in DTLOR_DP.DP) is above the cutoff for every cost vector.
+    Returns ((C, best_switch, null), cost) with the [P] array of costs, or
+    (None, bound) with the lower bounds if the DP stopped early. clade_cache
+    and clade_done are as in DP, and clade_cache must only be shared between
+    calls with the same costs.
+    """
+    parasite_root = next(iter(parasite_tree))
+    left, right = np.array(host.left), np.array(host.right)
+    by_height = [np.array(level) for level in host.by_height]
+    by_depth = [np.array(level) for level in host.by_depth]
+    internal = np.nonzero(~np.array(host.is_tip))[0]
+    tips = np.nonzero(np.array(host.is_tip))[0]
+    locus_index = {l: j for j, l in enumerate(loci)}
+    n_costs, n_hosts, n_loci = len(costs), len(host), len(loci)
+    # Each cost as a [P, 1, 1] array, to broadcast against the tables
+    D, T, L, Origin, R = [costs[:, k, None, None] for k in range(5)]
+
+    # Gene edge -> array with the table for that gene edge
+    # C and O are [P, host edge, locus], null is the cost of C[(ep, host_root, "*")]
+    C = {}
+    best_switch = {}
+    null = {}
+    # Lower bound on the cost, as in DTLOR_DP.DP: the sum of the cheapest
+    # entries of the clades computed so far whose parents are not
+    clade_min = {}
+    lower_bound = np.zeros(n_costs)
+    def add_to_bound(ep):
+        nonlocal lower_bound
+        _, _, ep1, ep2 = parasite_tree[ep]
+        lower_bound += clade_min[ep]
+        if ep1 is not None:
+            lower_bound -= clade_min[ep1] + clade_min[ep2]
+    fill_start = instrument.start()
+    for ep in postorder(parasite_tree, parasite_root):
+        if clade_cache is not None and ep != parasite_root:
+            key = clade_key(parasite_tree, parasite_root, ep)
+            if key in clade_cache:
+                C[ep], best_switch[ep], null[ep], clade_min[ep] = clade_cache[key]
+                add_to_bound(ep)
+                continue
+        # Only check the bound before filling a table, since reusing cached
+        # tables is cheap
+        if cutoff is not None and (lower_bound > cutoff + Epsilon).all():
+            instrument.stop("dp fill", fill_start)
+            return None, lower_bound
+        _, vp, ep1, ep2 = parasite_tree[ep]
+        C_ep = np.full((n_costs, n_hosts, n_loci), Infinity)
+        if ep1 is None:
+            # A tip maps only to its own species and locus
+            C_ep[:, host.index[phi[vp]], locus_index[locus_map[vp]]] = 0
+            null_ep = np.full(n_costs, Infinity)
+        else:
+            C1, C2 = C[ep1], C[ep2]
+            M1, M2 = switch_minimum(C1, R), switch_minimum(C2, R)
+            min1, min2 = C1.min(axis=2), C2.min(axis=2)
+            # Cospeciations
+            l, r = left[internal], right[internal]
+            C_ep[:, internal] = np.minimum(M1[:, l] + M2[:, r], M1[:, r] + M2[:, l])
+            # Duplications (the children's syntenic locations are free)
+            C_ep = np.minimum(C_ep, (min1 + min2 + D[:, 0])[:, :, None])
+            # Transfers, the transferred child keeps the parent's location
+            C_ep = np.minimum(C_ep, np.minimum(T + M1 + best_switch[ep2], T + M2 + best_switch[ep1]))
+            # Not giving ep a syntenic location
+            null_start = instrument.start()
+            n1, n2 = null[ep1], null[ep2]
+            m1, m2 = min1.min(axis=1), min2.min(axis=1)
+            origin = Origin[:, 0, 0]
+            null_ep = np.minimum(np.minimum(n1 + m2 + origin, m1 + n2 + origin), \
+                    np.minimum(n1 + n2, m1 + m2 + 2 * origin))
+            null_seconds = instrument.stop("null step", null_start)
+            if null_seconds is not None:
+                # The null step is its own phase, not part of "dp fill"
+                fill_start += null_seconds
+        # The root must factor in the cost of getting a syntenic location.
+        # As in DTLOR_DP.DP, it is added to each host edge before the losses
+        # at its parent use it, so a loss at the root pays it again.
+        root_origin = Origin if ep == parasite_root else 0
+        C_ep[:, tips] += root_origin
+        # Losses, bottom up over the host tree
+        for level in by_height:
+            loss = L + np.minimum(C_ep[:, left[level]], C_ep[:, right[level]])
+            C_ep[:, level] = np.minimum(C_ep[:, level], loss) + root_origin
+        # O is the best C in the host subtree. It is only needed for best_switch.
+        O_ep = C_ep.copy()
+        for level in by_height:
+            O_ep[:, level] = np.minimum(O_ep[:, level], np.minimum(O_ep[:, left[level]], O_ep[:, right[level]]))
+        # best_switch is the best O among host edges that are neither
+        # ancestors nor descendants
+        switch_ep = np.full((n_costs, n_hosts, n_loci), Infinity)
+        for level in by_depth:
+            l, r = left[level], right[level]
+            switch_ep[:, l] = np.minimum(switch_ep[:, level], O_ep[:, r])
+            switch_ep[:, r] = np.minimum(switch_ep[:, level], O_ep[:, l])
+        C[ep], best_switch[ep], null[ep] = C_ep, switch_ep, null_ep
+        if instrument.recorder is not None:
+            instrument.recorder.cells += C_ep.size + n_costs
+        clade_min[ep] = np.minimum(C_ep.min(axis=(1, 2)), null_ep)
+        if clade_cache is not None and ep != parasite_root:
+            clade_cache[key] = (C_ep, switch_ep, null_ep, clade_min[ep])
+            if clade_done is not None:
+                clade_done()
+        add_to_bound(ep)
+
+    cost = np.minimum(C[parasite_root].min(axis=(1, 2)), null[parasite_root])
+    instrument.stop("dp fill", fill_start)
+    return (C, best_switch, null), cost
+
+def DP(host_tree, parasite_tree, phi, locus_map, D, T, L, Origin, R, clade_cache=None, track_events=True, cutoff=Infinity, graph=False, clade_done=None):
+    """ Array-backed version of DTLOR_DP.DP. Takes the same arguments
+        and returns the same (MPR, cost), or (MPRGraph, cost) if graph is
+        True. clade_cache and clade_done work as in DTLOR_DP.DP, but
+        clade_cache holds arrays and must not be shared with that
+        engine. The tables never hold events, so they can be shared between
+        calls with and without track_events. cutoff works as in
+        DTLOR_DP.DP, with the same lower bound. """
+    host = host_tree_index(host_tree)
+    # in a fixed order, so that the locus axis of the tables doesn't depend
+    # on the order of locus_map (e.g. for checkpointed tables)
+    loci = sorted(set(locus_map.values()), key=repr)
+    costs = np.array([[D, T, L, Origin, R]], dtype=float)
+    tables, cost = fill_tables(host, parasite_tree, phi, locus_map, loci, costs, clade_cache, np.array([cutoff]), clade_done)
+    if tables is None or not track_events:
+        return None, float(cost[0])
+    # The tables for the only cost vector
+    C, best_switch, null = [{ep: table[0] for ep, table in tables_.items()} for tables_ in tables]
+    return traceback(host, parasite_tree, phi, locus_map, loci, C, best_switch, null, D, T, L, Origin, R, graph), float(cost[0])
+
+def DP_sweep(host_tree, parasite_tree, phi, locus_map, costs, clade_cache=None, track_events=False, cutoff=None, traced=None, graph=False):
+    """ Runs DP for each of a list of cost vectors (D, T, L, Origin, R) at
+        once. Everything that only depends on the trees and maps is shared,
+        and the tables are filled with the arithmetic vectorized over the
+        cost vectors (see fill_tables). Returns (MPRs, costs), where costs is
+        an array with the cost for each cost vector and MPRs is a list with
+        an MPR for each cost vector if track_events, or None. clade_cache is
+        as in DP, and must only be shared between calls with the same list
+        of cost vectors. If cutoff (an array of cutoffs, one per cost vector)
+        is given, the DP may stop early as in DP once the cost for every
+        cost vector is more than its cutoff, and then returns lower bounds.
+        If traced (a list of indices into costs) is given with
+        track_events, only the MPRs of those cost vectors are traced back,
+        and the others are None. If graph is True, each MPR is an MPRGraph
+        of all the MPRs for its cost vector instead. """
+    host = host_tree_index(host_tree)
+    loci = sorted(set(locus_map.values()), key=repr)
+    costs = np.array(costs, dtype=float)
+    if cutoff is not None:
+        cutoff = np.array(cutoff, dtype=float)
+    tables, cost = fill_tables(host, parasite_tree, phi, locus_map, loci, costs, clade_cache, cutoff)
+    if tables is None or not track_events:
+        return None, cost
+    MPRs = [None] * len(costs)
+    for k in (range(len(costs)) if traced is None else traced):
+        D, T, L, Origin, R = costs[k]
+        C, best_switch, null = [{ep: table[k] for ep, table in tables_.items()} for tables_ in tables]
+        MPRs[k] = traceback(host, parasite_tree, phi, locus_map, loci, C, best_switch, null, D, T, L, Origin, R, graph)
+    return MPRs, cost
+
+def traceback(host, parasite_tree, phi, locus_map, loci, C, best_switch, null, D, T, L, Origin, R, graph=False):
+    """
+    Returns a random MPR from the tables for a single cost vector, where C
+    and best_switch map each gene edge to a [host edge, locus] array and
+    null maps it to the cost of not giving it a syntenic location. If
+    graph is True, returns an MPRGraph of all the MPRs instead.
+    """
+    parasite_root = next(iter(parasite_tree))
+    host_root = host.root
+    host_edges = host.edges
+    host_index = host.index
+    left, right = host.left, host.right
+    is_tip = host.is_tip
+    locus_index = {l: j for j, l in enumerate(loci)}
+    n_hosts, n_loci = len(host_edges), len(loci)
+    C_root = C[parasite_root]
+    min_cost = min(C_root.min(), null[parasite_root])
+
+    def is_min(cost, target):
+        return cost <= target + Epsilon
+
+    def argmin_loci(row, target):
+        return [loci[j] for j in np.nonzero(row <= target + Epsilon)[0]]
+
+    def switch_loci(row, lp, target):
+        # Locations for a child whose parent is at lp with cost row[l] + delta_r(lp, l)
+        costs = row + R
+        costs[locus_index[lp]] = row[locus_index[lp]]
+        return argmin_loci(costs, target)
+
+    def switch_locations(ep, i, j, target):
+        # Host edges that are neither ancestors nor descendants of i
+        # where ep can be transferred at cost target
+        return [host_edges[h] for h in host.incomparable(i) if is_min(C[ep][h, j], target)]
+
+    def events(mapping):
+        """
+        Recover the events of minimum cost for a mapping node from the tables.
+        """
+        ep, eh, lp = mapping
+        _, vp, ep1, ep2 = parasite_tree[ep]
+        if lp == "*":
+            return null_events(ep, ep1, ep2)
+        i, j = host_index[eh], locus_index[lp]
+        # At the root, C includes the cost of getting a syntenic location.
+        # The losses there use C of the child host edge with that cost in
+        # it, as in fill_tables, so only the target has it taken off.
+        target = C[ep][i, j] - (Origin if ep == parasite_root else 0)
+        found = []
+        if is_tip[i]:
+            if ep1 is None and phi[vp] == eh and locus_map[vp] == lp:
+                found.append(("C", None, None))
+        else:
+            eh1, eh2 = host_edges[left[i]], host_edges[right[i]]
+            if ep1 is not None:
+                C1, C2 = C[ep1], C[ep2]
+                M1, M2 = switch_minimum(C1[[left[i], right[i]]], R), switch_minimum(C2[[left[i], right[i]]], R)
+                for a, b, h1, h2 in ((0, 1, eh1, eh2), (1, 0, eh2, eh1)):
+                    if is_min(M1[a, j] + M2[b, j], target):
+                        for l1 in switch_loci(C1[host_index[h1]], lp, M1[a, j]):
+                            for l2 in switch_loci(C2[host_index[h2]], lp, M2[b, j]):
+                                found.append(("S", (ep1, h1, l1), (ep2, h2, l2)))
+            if is_min(L + C[ep][right[i], j], target):
+                found.append(("L", (vp, eh2, lp), None))
+            if is_min(L + C[ep][left[i], j], target):
+                found.append(("L", (vp, eh1, lp), None))
+        if ep1 is not None:
+            C1, C2 = C[ep1], C[ep2]
+            min1, min2 = C1[i].min(), C2[i].min()
+            if is_min(min1 + min2 + D, target):
+                for l1 in argmin_loci(C1[i], min1):
+                    for l2 in argmin_loci(C2[i], min2):
+                        found.append(("D", (ep1, eh, l1), (ep2, eh, l2)))
+            for kept, moved in ((ep1, ep2), (ep2, ep1)):
+                M_kept = switch_minimum(C[kept][[i]], R)[0, j]
+                moved_cost = best_switch[moved][i, j]
+                if is_min(T + M_kept + moved_cost, target):
+                    for new_l in switch_loci(C[kept][i], lp, M_kept):
+                        for location in switch_locations(moved, i, j, moved_cost):
+                            found.append(("T", (kept, eh, new_l), (moved, location, lp)))
+        return found
+
+    def null_events(ep, ep1, ep2):
+        found = []
+        if ep1 is None:
+            return found
+        target = null[ep]
+        C1, C2 = C[ep1], C[ep2]
+        n1, n2 = null[ep1], null[ep2]
+        m1, m2 = C1.min(), C2.min()
+        args1 = [(host_edges[i], loci[j]) for i, j in zip(*np.nonzero(C1 <= m1 + Epsilon))]
+        args2 = [(host_edges[i], loci[j]) for i, j in zip(*np.nonzero(C2 <= m2 + Epsilon))]
+        if is_min(n1 + m2 + Origin, target):
+            found.extend(("N", (ep1, host_root, "*"), (ep2, eh, l)) for eh, l in args2)
+        if is_min(m1 + n2 + Origin, target):
+            found.extend(("N", (ep1, eh, l), (ep2, host_root, "*")) for eh, l in args1)
+        if is_min(n1 + n2, target):
+            found.append(("N", (ep1, host_root, "*"), (ep2, host_root, "*")))
+        if is_min(m1 + m2 + 2 * Origin, target):
+            found.extend(("N", (ep1, eh1, l1), (ep2, eh2, l2)) for eh1, l1 in args1 for eh2, l2 in args2)
+        return found
+
+    # Find the mapping nodes involving the root of minimum cost
+    best_roots = [(parasite_root, host_edges[i], loci[j]) for j in range(n_loci) for i in range(n_hosts) \
+            if is_min(C_root[i, j], min_cost)]
+    if is_min(null[parasite_root], min_cost):
+        best_roots.append((parasite_root, host_root, "*"))
+
+    with instrument.timed("traceback"):
+        if graph:
+            return MPRGraph(best_roots, MPR_graph(best_roots, events))
+        # This picks a random MPR from the optimal ones
+        return find_MPR(best_roots, events)
@@ -9,7 +9,8 @@
 # vertex-based DP algorithm. The main function in this file is called Greedy
 # and the remaining functions are helper functions that are used by Greedy.
 
-import copy 
+import heapq
+import DTLOR_DP
 
 
 def findRoot(Tree):
@@ -21,61 +22,70 @@ def findRoot(Tree):
     return Tree['hTop'][1] 
 
 
+def isNullChild(child):
+    """This function takes in a child of an event and returns True if it is
+    the null child, (None, None, None, None), or None."""
+
+    return child is None or child[0] is None
+
+
+def topologicalOrder(DTLOR, topNodes=None):
+    """This function takes in a DTLOR graph and optionally a list of mapping
+    nodes, topNodes, and returns a list, orderedKeysL, of the mapping nodes
+    reachable from topNodes (all of them if topNodes is None), each once,
+    ordered so that the children of every event come before the mapping node
+    the event belongs to. It runs in time linear in the size of the graph."""
+
+    if topNodes is None:
+        topNodes = list(DTLOR)
+    # DTLOR_DP.graph_postorder takes a graph whose events are (type, child,
+    # child) with None for a null child, and starts from the last root
+    graph = {}
+    for mapNode in DTLOR:
+        graph[mapNode] = [(event[0], None if isNullChild(event[1]) else event[1],
+                           None if isNullChild(event[2]) else event[2])
+                          for event in DTLOR[mapNode][:-1]]
+    return DTLOR_DP.graph_postorder(graph, list(reversed(topNodes)))
+
+
 def orderDTLOR(DTLOR, ParasiteRoot):
     """This function takes in a DTLOR graph and the ParasiteRoot. It outputs a 
-    list, keysL, that contains tuples. Each tuple has two elements. The first
-    is a mapping node of the form (p, h, l, l), where p is a parasite node and h is 
-    a host node, l is the syntenic location of p. The second element is a level representing the depth of that
-    mapping node within the tree."""
+    dictionary, levelsD, from each mapping node of the form (p, h, l, l)
+    reachable from the mapping nodes of ParasiteRoot to its level, where p is
+    a parasite node, h is a host node and l is the syntenic location of p. The
+    level of a mapping node is its greatest depth below the mapping nodes of
+    ParasiteRoot, which are at level 0, so every child of an event has a
+    higher level than the mapping node of the event. Each mapping node is
+    visited once, however many paths lead to it, so this runs in time linear
+    in the size of the graph."""
 
-    keysL = []
-    topNodes = []
-    for key in DTLOR:
-        if key[0] == ParasiteRoot:
-            topNodes.append(key)
-    for vertex in topNodes:
-        keysL.extend(orderDTLOR_Roots(DTLOR, vertex, 0))
-    return keysL
-
-
-def orderDTLOR_Roots(DTLOR, vertex, level):
-    """This function takes a DTL graph, one node, a vertex, of the DTL graph, 
-    and level, and returns a list, keysL, that contains tuples. Each tuple has
-    two elements. The first is a mapping node of the form (p, h, l, l), where p is a
-    parasite node, h is a host node and l is the syntenic location of p. 
-    The second element is a level representing the depth of that mapping node 
-    within the tree. This function adds the input vertex to keysL and recurses 
-    on its children."""
-
-    keysL = []
-    # Loop through each event associated with key in DTL
-    for i in range(len(DTLOR[vertex]) - 1):
-        event = DTLOR[vertex][i]
-        child1 = event[1]
-        child2 = event[2]
-        keysL = keysL + [(vertex, level)]
-        if child1[0] is not None:
-            keysL.extend(orderDTLOR_Roots(DTLOR, child1, level + 1))
-        if child2[0] is not None:
-            keysL.extend(orderDTLOR_Roots(DTLOR, child2, level + 1)) 
-    return keysL
-
-
-def sortHelper(DTLOR, keysL):
-    """This function takes in a list keysL,and a DTLOR graph, and returns a new 
-    list, uniqueKeysL that has removed duplicate mapping nodes from keysL.
-    This function chooses the highest level for each mapping node because we 
-    are using the bottom-up approach."""
-    
-    uniqueKeysL = []
+    topNodes = [key for key in DTLOR if key[0] == ParasiteRoot]
+    levelsD = dict.fromkeys(topNodes, 0)
+    # Parents before children, so the level of a mapping node is final
+    # before it is passed down
+    for mapNode in reversed(topologicalOrder(DTLOR, topNodes)):
+        level = levelsD[mapNode] + 1
+        for i in range(len(DTLOR[mapNode]) - 1):
+            event = DTLOR[mapNode][i]
+            for child in (event[1], event[2]):
+                if not isNullChild(child) and levelsD.get(child, -1) < level:
+                    levelsD[child] = level
+    return levelsD
+
+
+def levelSort(DTLOR, ParasiteRoot):
+    """This function takes in a DTL graph and ParasiteRoot, and returns a 
+    list, orderedKeysL, of (mapping node, level) tuples ordered by level from
+    smallest to largest, where level 0 is the root and the highest level has
+    tips (see orderDTLOR). Mapping nodes of the same level are in the order
+    of DTLOR."""
+
+    levelsD = orderDTLOR(DTLOR, ParasiteRoot)
+    levelBucketsL = [[] for level in range(max(levelsD.values(), default=-1) + 1)]
     for key in DTLOR:
-        maxLevel = float("-inf")
-        for element in keysL:
-            if key == element[0]:
-                if element[1] > maxLevel:
-                    maxLevel = element[1]
-        uniqueKeysL.append((key, maxLevel))
-    return uniqueKeysL
+        if key in levelsD:
+            levelBucketsL[levelsD[key]].append((key, levelsD[key]))
+    return [mapping for bucketL in levelBucketsL for mapping in bucketL]
 
 
 def postorderDTLsort(DTLOR, ParasiteRoot):
@@ -83,15 +93,8 @@ def postorderDTLsort(DTLOR, ParasiteRoot):
     sorted list, orderedKeysL, that is ordered by level from largest to 
     smallest, where level 0 is the root and the highest level are tips."""
 
-    keysL = orderDTLOR(DTLOR, ParasiteRoot)
-    uniqueKeysL = sortHelper(DTLOR, keysL)
-    orderedKeysL = []
-    levelCounter = 0
-    while len(orderedKeysL) < len(uniqueKeysL):
-        for mapping in uniqueKeysL:
-            if mapping[-1] == levelCounter:
-                orderedKeysL = [mapping] + orderedKeysL
-        levelCounter += 1
+    orderedKeysL = levelSort(DTLOR, ParasiteRoot)
+    orderedKeysL.reverse()
     return orderedKeysL
 
 
@@ -146,34 +149,24 @@ def TraceChildren(DTLOR, GreedyOnce, BSFHMap, key):
     0."""
 
     resetDTLOR = {}  # The new DTL graph
-    reset1DTLOR = {}  # This DTL graph deals with the recursive call on the child1
-    reset2DTLOR = {}  # This DTL graph deals with the recursive call on the child2
-    child1 = GreedyOnce[key][1]
-    child2 = GreedyOnce[key][2]
-    if child1 != (None, None, None, None):
-        GreedyOnce[child1] = BSFHMap[child1][0][0:3]  # Add event to greedyOnce, without the score
+    # The mapping nodes below key are visited in preorder, the first child
+    # of each event and everything below it before the second child
+    stack = []
+    for child in (GreedyOnce[key][2], GreedyOnce[key][1]):
+        if child != (None, None, None, None):
+            stack.append(child)
+    while stack:
+        child = stack.pop()
+        GreedyOnce[child] = BSFHMap[child][0][0:3]  # Add event to greedyOnce, without the score
         # This loop resets all the scores of events that have been used to 0
-        for i in range(len(DTLOR[child1]) - 1):       
-            if DTLOR[child1][i] == BSFHMap[child1][0]:
-                newValue = DTLOR[child1]
+        for i in range(len(DTLOR[child]) - 1):
+            if DTLOR[child][i] == BSFHMap[child][0]:
+                newValue = DTLOR[child]
                 newValue[i][-1] = 0
-                reset1DTLOR[child1] = newValue
-        # This recursive call updates GreedyOnce and the DTL graph
-        newGreedyOnce, DTLOR1 = TraceChildren(DTLOR, GreedyOnce, BSFHMap, child1) 
-        reset1DTLOR.update(DTLOR1)
-        GreedyOnce.update(newGreedyOnce)
-    if child2 != (None, None, None, None):
-        GreedyOnce[child2] = BSFHMap[child2][0][0:3]
-        for i in range(len(DTLOR[child2]) - 1): 
-            if DTLOR[child2][i] == BSFHMap[child2][0]:
-                newValue = DTLOR[child2]
-                newValue[i][-1] = 0
-                reset2DTLOR[child2] = newValue      
-        newGreedyOnce, DTLOR2 = TraceChildren(DTLOR, GreedyOnce, BSFHMap, child2)
-        reset2DTLOR.update(DTLOR2)
-        GreedyOnce.update(newGreedyOnce)
-    resetDTLOR.update(reset1DTLOR)
-    resetDTLOR.update(reset2DTLOR)
+                resetDTLOR[child] = newValue
+        for grandchild in (GreedyOnce[child][2], GreedyOnce[child][1]):
+            if grandchild != (None, None, None, None):
+                stack.append(grandchild)
     return GreedyOnce, resetDTLOR
 
 
@@ -215,24 +208,120 @@ def greedyOnce(DTLOR, ParasiteTree):
     return GreedyOnce, DTLOR, bestScore
 
 
+def parentsOf(DTLOR):
+    """This function takes in a DTLOR graph and returns a dictionary from
+    each mapping node to the list of mapping nodes that have an event with it
+    as a child."""
+
+    parentsD = {key: [] for key in DTLOR}
+    for key in DTLOR:
+        for i in range(len(DTLOR[key]) - 1):
+            event = DTLOR[key][i]
+            for child in (event[1], event[2]):
+                if not isNullChild(child):
+                    parentsD[child].append(key)
+    return parentsD
+
+
+def bestEvent(DTLOR, eventScores, BSFHMap, mapNode):
+    """This function takes in a DTLOR graph, a dictionary eventScores of the
+    current scores of the events of each mapping node, a BSFHMap dictionary
+    holding the best scores of the children of mapNode, and mapNode. It
+    returns [i, maxScore] where i is the index in DTLOR[mapNode] of the event
+    with the max score, as in bookkeeping."""
+
+    scoresL = eventScores[mapNode]
+    # Check if the key is a tip:
+    if DTLOR[mapNode][0][0] == 'C':
+        return [0, scoresL[0]]
+    maxScore = float("-inf")
+    maxIndex = None
+    for i in range(len(DTLOR[mapNode]) - 1):
+        event = DTLOR[mapNode][i]
+        score = scoresL[i]
+        if not isNullChild(event[1]):
+            score += BSFHMap[event[1]][-1]
+        if not isNullChild(event[2]):
+            score += BSFHMap[event[2]][-1]
+        if score > maxScore:
+            maxScore = score
+            maxIndex = i
+    return [maxIndex, maxScore]
+
+
 def Greedy(DTLOR, ParasiteTree):
     """This function takes as input a DTL graph and a ParasiteTree, and 
     returns TreeList, a list of dictionaries, each of which represent one of 
     the optimal reconciliations. This function runs till all the scores have 
-    been collected from the DTL graph."""
+    been collected from the DTL graph.
+
+    This gives the same reconciliations as calling greedyOnce repeatedly
+    (up to ties between equal scores),
+    but rather than redoing bookkeeping over the whole graph each time, it
+    only updates the best scores of the mapping nodes whose events were
+    reset to 0 and of their ancestors. The scores are kept apart from the
+    DTL graph, which is not changed."""
+
+    ParasiteRoot = findRoot(ParasiteTree)
+    # Current scores of the events of each mapping node
+    eventScores = {key: [DTLOR[key][i][-1] for i in range(len(DTLOR[key]) - 1)] for key in DTLOR}
+    # Number of events whose score hasn't been collected yet
+    uncollected = sum(1 for key in eventScores for score in eventScores[key] if score != 0)
+    parentsD = parentsOf(DTLOR)
+    orderedKeysL = topologicalOrder(DTLOR)
+    position = {key: i for i, key in enumerate(orderedKeysL)}
+    topNodes = [key for key in DTLOR if key[0] == ParasiteRoot]
+
+    # BSFHMap = {(mapping node): [index of the event with the max score, maxScore]}
+    BSFHMap = {}
+    for key in orderedKeysL:
+        BSFHMap[key] = bestEvent(DTLOR, eventScores, BSFHMap, key)
+
     scores = []  # List of reconciliation scores
-    currentDTLOR = copy.deepcopy(DTLOR)
-    rec = [] # List of reconciliations
-    collected = True
-    while collected:
-        # Call greedyOnce if all the points have not been collected yet
-        oneTree, currentDTLOR, score = greedyOnce(currentDTLOR, ParasiteTree)
-        scores.append(score) 
+    rec = []  # List of reconciliations
+    while True:
+        bestKey = ()
+        bestScore = float("-inf")
+        for key in topNodes:
+            if BSFHMap[key][-1] > bestScore:
+                bestKey = key
+                bestScore = BSFHMap[key][-1]
+
+        # Trace the reconciliation down from bestKey, resetting the scores
+        # of its events to 0
+        oneTree = {}
+        resetL = []
+        stack = [bestKey]
+        while stack:
+            key = stack.pop()
+            i = BSFHMap[key][0]
+            event = DTLOR[key][i]
+            oneTree[key] = list(event[0:3])
+            if eventScores[key][i] != 0:
+                eventScores[key][i] = 0
+                uncollected -= 1
+                resetL.append(key)
+            for child in (event[1], event[2]):
+                if not isNullChild(child):
+                    stack.append(child)
+        scores.append(bestScore)
         rec.append(oneTree)
-        collected = False  # Set not0 to False
-        # Iterate to see if more points need to be collected
-        for key in currentDTLOR:
-            for i in range(len(currentDTLOR[key])-1):
-                if currentDTLOR[key][i][-1] != 0:
-                    collected = True
+        # Stop once all the scores have been collected (or if none could be)
+        if uncollected == 0 or not resetL:
+            break
+
+        # Update the best scores, children before parents, going up to a
+        # parent only if the score of a child changed
+        heap = [(position[key], key) for key in resetL]
+        heapq.heapify(heap)
+        queued = set(resetL)
+        while heap:
+            _, key = heapq.heappop(heap)
+            oldScore = BSFHMap[key][-1]
+            BSFHMap[key] = bestEvent(DTLOR, eventScores, BSFHMap, key)
+            if BSFHMap[key][-1] != oldScore:
+                for parent in parentsD[key]:
+                    if parent not in queued:
+                        queued.add(parent)
+                        heapq.heappush(heap, (position[parent], parent))
     return scores, rec
@@ -0,0 +1,206 @@
+import sys,os,io,copy,json,math,time,random,platform,argparse,resource,subprocess,contextlib,tempfile
+from multiprocessing import Pool
+import trees,familiesDTLORstuff,mapIndex,instrument,simulateFamilies
+from runDTLOR_DP import D,T,L,O,R,engine,mapIndexDir,loadD
+
+# Benchmarks of reconcile, so that changes to the DP engines can be
+# compared run over run. The cases are the four gene tree families in
+# this directory, and series of synthetic families (simulated with
+# simulateFamilies.py) that each vary one of gene tree size, species
+# tree size, number of distinct loci and number of valid rootings,
+# holding the rest fixed. For each case we record the
+# wall time, the peak memory and the number of DP table cells computed
+# (see instrument.py). Each case is run in a fresh process, so that its
+# peak memory is its own.
+#
+# The results are saved as JSON (--out). Comparing to an earlier
+# results file (--compare) prints the ratio of the times. For each
+# synthetic series, the slope of log(time) against log(size) is printed,
+# which is the exponent of the scaling in that size.
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+
+bundledFamiliesL = ['initFam001601','initFam000220','initFam000060','initFam000001']
+
+# synthetic series: name, parameter varied, its values, and the size in
+# the results that the time scales with. The other parameters are as in
+# defaultParamsD. numGenes and numSpecies are tip counts. numLoci is the
+# number of locations a family can use, so distinct loci grow with it
+# given a high rearrangement rate. With no duplications to new
+# locations, the fewer rearrangements the more clades share a location,
+# and the fewer the valid rootings.
+defaultParamsD = {'numGenes':32,'numSpecies':8,'numLoci':None,'rearrangeRate':0.2,'dupNewLocusProb':0.5}
+seriesL = [('geneTree',{'numGenes':[8,16,32,64,128,256]},'numGenes'),
+           ('speciesTree',{'numSpecies':[4,8,16,32,64,128]},'numSpecies'),
+           ('loci',{'numLoci':[1,2,4,8,16,32],'rearrangeRate':[2.0]},'numLoci'),
+           ('rootings',{'rearrangeRate':[0.0,0.05,0.2,0.5,2.0],'dupNewLocusProb':[0.0]},'numRootings')]
+
+## funcs
+
+def syntheticFamily(numGenes,numSpecies,seed,dupRate=0.3,maxTries=10,**ratesD):
+    '''Simulate a family with numGenes genes on a random species tree
+with numSpecies tips, write it out and read it back in. Returns
+(speciesTree,geneTree,tipMapD,gtLocusMapD). If the rates give too few
+genes, dupRate is raised by half and the family simulated again, up to
+maxTries times, after which a ValueError is raised.'''
+    speciesTree=simulateFamilies.randomSpeciesTree(numSpecies,random.Random(seed))
+    firstDupRate=dupRate
+    with tempfile.TemporaryDirectory() as familyDir:
+        for i in range(maxTries):
+            try:
+                geneTreeFN,=simulateFamilies.writeFamilies(speciesTree,familyDir,1,seed,numGenes,numGenes, \
+                                                           dupRate=dupRate,**ratesD)
+                break
+            except ValueError:
+                # too few genes, make more duplications
+                dupRate*=1.5
+        else:
+            raise ValueError("No family with numGenes={}, numSpecies={}, seed={} and rates {} in {} tries (dupRate raised from {} to {}). Try other rates.".format(numGenes,numSpecies,seed,ratesD,maxTries,firstDupRate,dupRate/1.5))
+        speciesTree=trees.readTree(os.path.join(familyDir,"speciesTree.tre"))
+        geneTree=trees.loadOneGeneTree(geneTreeFN)
+        tipMapD=loadD(os.path.join(familyDir,"tipMap.tsv"))
+        gtLocusMapD=loadD(os.path.join(familyDir,"locusMap.tsv"))
+    return speciesTree,geneTree,tipMapD,gtLocusMapD
+
+def bundledFamily(family):
+    '''Load one of the families in this directory.'''
+    speciesTree=trees.readTree(os.path.join(scriptDir,"speciesTree.tre"))
+    geneTree=trees.loadOneGeneTree(os.path.join(scriptDir,family+".tre"))
+    mapIndexO=mapIndex.loadMapIndex(os.path.join(scriptDir,"tipMap.tsv"),os.path.join(scriptDir,"locusMap.tsv"),os.path.join(scriptDir,mapIndexDir))
+    tipMapD=mapIndexO.tipMap(trees.leafList(geneTree))
+    gtLocusMapD=mapIndexO.locusMap(trees.leafList(geneTree))
+    return speciesTree,geneTree,tipMapD,gtLocusMapD
+
+def makeCases(quick):
+    '''Return the list of cases, each a dict with name, series, x (the
+value of the varied parameter) and what's needed to make the family.'''
+    casesL=[]
+    for family in bundledFamiliesL:
+        casesL.append({'name':family,'series':'bundled','x':None,'family':family})
+    for series,variedD,size in seriesL:
+        # the first parameter is varied, the others are set for the series
+        param,valuesL=next(iter(variedD.items()))
+        if quick:
+            valuesL=valuesL[:3]
+        for value in valuesL:
+            paramsD=dict(defaultParamsD)
+            for otherParam,(otherValue,*_) in variedD.items():
+                paramsD[otherParam]=otherValue
+            paramsD[param]=value
+            casesL.append({'name':"{}_{}{}".format(series,param,value),'series':series,'x':value,'params':paramsD})
+    return casesL
+
+def runCase(argT):
+    '''Run one case in this (fresh) process, and return its results.'''
+    caseD,engine,repeats,seed=argT
+    if 'family' in caseD:
+        speciesTree,geneTree,tipMapD,gtLocusMapD=bundledFamily(caseD['family'])
+    else:
+        speciesTree,geneTree,tipMapD,gtLocusMapD=syntheticFamily(seed=seed,**caseD['params'])
+    locusMapForRootingD=trees.createLocusMapForRootingD(geneTree,copy.deepcopy(gtLocusMapD))
+    argT=(speciesTree,geneTree,tipMapD,gtLocusMapD,locusMapForRootingD,D,T,L,O,R)
+
+    startRSS=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    secondsL=[]
+    for i in range(repeats):
+        random.seed(seed)
+        recorder=instrument.enable()
+        startTime=time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            familiesDTLORstuff.reconcile(argT,engine)
+        secondsL.append(time.perf_counter()-startTime)
+        instrument.disable()
+    # ru_maxrss is in kB on linux
+    peakRSS=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    resultD=dict(caseD)
+    resultD.update({'numGenes':trees.leafCount(geneTree),
+                    'numSpecies':trees.leafCount(speciesTree),
+                    'numLoci':len(set(gtLocusMapD.values())),
+                    'numRootings':len(trees.get_all_rerootings(geneTree,locusMapForRootingD)),
+                    'seconds':min(secondsL),
+                    'secondsL':secondsL,
+                    'cells':recorder.cells,
+                    'cellsPerSec':recorder.cells/min(secondsL),
+                    'peakRSSMB':peakRSS/1024,
+                    'peakRSSIncreaseMB':(peakRSS-startRSS)/1024})
+    return resultD
+
+def scalingExponent(resultsL,size):
+    '''Least squares slope of log(seconds) against log(size), or None if
+there are fewer than two distinct sizes.'''
+    pointsL=[(math.log(r[size]),math.log(r['seconds'])) for r in resultsL if r[size]>0 and r['seconds']>0]
+    if len(pointsL)<2:
+        return None
+    meanX=sum(x for x,y in pointsL)/len(pointsL)
+    meanY=sum(y for x,y in pointsL)/len(pointsL)
+    sxx=sum((x-meanX)**2 for x,y in pointsL)
+    if sxx==0:
+        return None
+    return sum((x-meanX)*(y-meanY) for x,y in pointsL)/sxx
+
+def gitCommit():
+    '''The commit of this directory, or None if it isn't a git repository.'''
+    try:
+        return subprocess.run(["git","rev-parse","HEAD"],cwd=scriptDir,capture_output=True,text=True,check=True).stdout.strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+def printResults(resultsL,compareD):
+    '''Print a table of the results, with the ratio to the time of the
+same case in compareD (name -> result) if there is one.'''
+    print("{:<28} {:>6} {:>5} {:>5} {:>8} {:>10} {:>12} {:>12} {:>9} {:>8}".format(
+        "case","genes","spec","loci","rootings","seconds","cells","cells/sec","peakMB","vs prev"))
+    for r in resultsL:
+        ratio=""
+        if r['name'] in compareD:
+            ratio="{:.2f}x".format(r['seconds']/compareD[r['name']]['seconds'])
+        print("{:<28} {:>6} {:>5} {:>5} {:>8} {:>10.4f} {:>12} {:>12.0f} {:>9.1f} {:>8}".format(
+            r['name'],r['numGenes'],r['numSpecies'],r['numLoci'],r['numRootings'],r['seconds'],
+            r['cells'],r['cellsPerSec'],r['peakRSSMB'],ratio))
+    print()
+    for series,variedD,size in seriesL:
+        exponent=scalingExponent([r for r in resultsL if r['series']==series],size)
+        if exponent is not None:
+            print("{}: time ~ {}^{:.2f}".format(series,size,exponent))
+
+## main
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark reconcile on the bundled and synthetic families.")
+    parser.add_argument("--out", default="benchmark.json", help="file to save the results to")
+    parser.add_argument("--compare", default=None, help="results file of an earlier run to compare with")
+    parser.add_argument("--engine", default=engine, choices=sorted(familiesDTLORstuff.enginesD), help="DP engine")
+    parser.add_argument("--repeats", type=int, default=3, help="runs of each case, the fastest is reported")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the synthetic families")
+    parser.add_argument("--quick", action="store_true", help="only the smaller synthetic families")
+    parser.add_argument("--cases", default=None, help="only run cases whose name contains this")
+    args = parser.parse_args()
+
+    casesL = [caseD for caseD in makeCases(args.quick) if args.cases == None or args.cases in caseD['name']]
+
+    resultsL = []
+    # a new process for each case, so peak memory is per case
+    with Pool(processes=1,maxtasksperchild=1) as p:
+        for resultD in p.imap(runCase,[(caseD,args.engine,args.repeats,args.seed) for caseD in casesL]):
+            print("{} {:.4f} s".format(resultD['name'],resultD['seconds']),file=sys.stderr)
+            resultsL.append(resultD)
+
+    compareD = {}
+    if args.compare != None:
+        with open(args.compare,"r") as f:
+            compareD = {r['name']:r for r in json.load(f)['results']}
+    printResults(resultsL,compareD)
+
+    runD = {'engine':args.engine,
+            'costs':{'D':D,'T':T,'L':L,'O':O,'R':R},
+            'repeats':args.repeats,
+            'seed':args.seed,
+            'commit':gitCommit(),
+            'python':platform.python_version(),
+            'machine':platform.platform(),
+            'date':time.strftime("%Y-%m-%d %H:%M:%S"),
+            'results':resultsL}
+    with open(args.out,"w") as f:
+        json.dump(runD,f,indent=1)
@@ -0,0 +1,136 @@
+import sys,os,copy,argparse,tempfile
+import trees,familiesDTLORstuff,resultCache,DTLOR_DP,DTLOR_DP_array,benchmarkDTLOR
+
+# Checks that the two DP engines (see familiesDTLORstuff.enginesD) agree.
+# For every rooting of a number of simulated families (see
+# simulateFamilies.py) and each cost vector in costsL, DTLOR_DP.DP and
+# DTLOR_DP_array.DP must give the same cost and the same MPR graph, and
+# DTLOR_DP_array.DP_sweep over all of costsL must give the same costs and
+# an MPR from that graph for each cost vector. The cost vectors include
+# ones where losses are free (L=0), which makes losses at the root of the
+# gene tree part of many MPRs. Each rooting is checked with the locus
+# map of the family, and with one that also has a gene outside the
+# tree, at a locus that no gene of the tree has. Then reconcile is run end to end, with
+# each engine, on a caterpillar gene tree (the deepest tree with its
+# number of tips), to check that nothing on the way recurses once per
+# level of the tree. Prints the cases that differ or fail, and exits
+# with status 1 if there are any.
+
+# cost vectors (D,T,L,O,R)
+costsL = [(0.3,0.4,0.4,0.1,0.2),
+          (1,1,1,0.2,0),
+          (0.5,0.1,0,0.5,0.1),
+          (1,2,0,1,1),
+          (0.5,0.5,0,0,0.5)]
+
+## funcs
+
+def eventSets(mprGraph):
+    '''Return the roots and the graph of an MPRGraph, with the events of
+each mapping node as a set, so graphs can be compared.'''
+    return set(mprGraph.roots),{mapping:set(eventsL) for mapping,eventsL in mprGraph.graph.items()}
+
+def checkRooting(speciesTreeD,geneTreeD,tipMapD,gtLocusMapD):
+    '''Check both engines on one rooting for all of costsL. Returns a list
+of strings describing the differences.'''
+    problemsL=[]
+    graphsL=[]
+    for costT in costsL:
+        dictGraph,dictCost=DTLOR_DP.DP(speciesTreeD,geneTreeD,tipMapD,gtLocusMapD,*costT,graph=True)
+        arrayGraph,arrayCost=DTLOR_DP_array.DP(speciesTreeD,geneTreeD,tipMapD,gtLocusMapD,*costT,graph=True)
+        if abs(dictCost-arrayCost)>DTLOR_DP.Epsilon:
+            problemsL.append("costs {}: cost {} (dict) vs {} (array)".format(costT,dictCost,arrayCost))
+        elif eventSets(dictGraph)!=eventSets(arrayGraph):
+            problemsL.append("costs {}: MPR graphs differ".format(costT))
+        graphsL.append((dictGraph,dictCost))
+    MPRs,sweepCosts=DTLOR_DP_array.DP_sweep(speciesTreeD,geneTreeD,tipMapD,gtLocusMapD,costsL,track_events=True)
+    for costT,(dictGraph,dictCost),MPR,sweepCost in zip(costsL,graphsL,MPRs,sweepCosts):
+        if abs(dictCost-sweepCost)>DTLOR_DP.Epsilon:
+            problemsL.append("costs {}: cost {} (dict) vs {} (sweep)".format(costT,dictCost,sweepCost))
+        elif any(event not in dictGraph.graph.get(mapping,[]) for mapping,event in MPR.items()):
+            problemsL.append("costs {}: sweep MPR not in the MPR graph".format(costT))
+    return problemsL
+
+def caterpillarFamily(numGenes):
+    '''A family whose gene tree is a caterpillar with numGenes tips, on a
+species tree with two tips. The genes are all at one locus but for
+the last few, so only the rootings near the top of the tree are valid.
+Returns (speciesTree,geneTree,tipMapD,gtLocusMapD).'''
+    speciesTree=("r",("a",(),(),None),("b",(),(),None),None)
+    geneTree=(0,(),(),None)
+    for gene in range(1,numGenes):
+        geneTree=("g"+str(gene),geneTree,(gene,(),(),None),None)
+    geneTree=("root",)+geneTree[1:]
+    tipMapD={gene:"a" if gene%2 else "b" for gene in range(numGenes)}
+    gtLocusMapD={gene:"A" if gene<numGenes-3 else "B" for gene in range(numGenes)}
+    return speciesTree,geneTree,tipMapD,gtLocusMapD
+
+def checkDeepFamily(numGenes):
+    '''Reconcile caterpillarFamily(numGenes) with each engine, storing
+the result in a result cache, and write the rooted tree, all with the
+default recursion limit. Returns a list of strings describing the
+failures.'''
+    problemsL=[]
+    speciesTree,geneTree,tipMapD,gtLocusMapD=caterpillarFamily(numGenes)
+    # xenoGI raises the recursion limit when it is imported, which
+    # would hide any recursion
+    recursionLimit=sys.getrecursionlimit()
+    sys.setrecursionlimit(1000)
+    try:
+        for engine in sorted(familiesDTLORstuff.enginesD):
+            try:
+                with tempfile.TemporaryDirectory() as cacheDir:
+                    resultCacheO=resultCache.ResultCache(os.path.join(cacheDir,"results.db"))
+                    locusMapForRootingD=trees.createLocusMapForRootingD(geneTree,copy.deepcopy(gtLocusMapD))
+                    argT=(speciesTree,geneTree,tipMapD,gtLocusMapD,locusMapForRootingD)+costsL[0]
+                    optRootedGeneTree,optMPR=familiesDTLORstuff.reconcile(argT,engine,verbose=False,resultCacheO=resultCacheO)
+                    trees.tupleTree2NoBrLenNewick(optRootedGeneTree)
+            except RecursionError:
+                problemsL.append("{} engine: recursion too deep".format(engine))
+                continue
+            if {mapping[0] for mapping in optMPR}!=set(trees.nodeList(optRootedGeneTree)):
+                problemsL.append("{} engine: MPR doesn't map every gene node".format(engine))
+    finally:
+        sys.setrecursionlimit(recursionLimit)
+    return problemsL
+
+## main
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Check that the DP engines agree on simulated families.")
+    parser.add_argument("--families", type=int, default=20, help="number of families")
+    parser.add_argument("--numGenes", type=int, default=8, help="genes per family")
+    parser.add_argument("--numSpecies", type=int, default=6, help="species in the species tree")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first family")
+    parser.add_argument("--deepGenes", type=int, default=2500, help="tips of the caterpillar gene tree reconciled end to end (0 to skip)")
+    args = parser.parse_args()
+
+    numRootings = 0
+    numProblems = 0
+    for seed in range(args.seed,args.seed+args.families):
+        speciesTree,geneTree,tipMapD,gtLocusMapD=benchmarkDTLOR.syntheticFamily(args.numGenes,args.numSpecies,seed,numLoci=3,rearrangeRate=0.5)
+        speciesTreeD=trees.parseTreeForDP(speciesTree,parasite=False)
+        locusMapForRootingD=trees.createLocusMapForRootingD(geneTree,copy.deepcopy(gtLocusMapD))
+        # a locus map with a locus that is absent from the tree
+        widerLocusMapD=dict(gtLocusMapD)
+        widerLocusMapD[max(gtLocusMapD)+1]="outside"
+        for rooting in trees.get_all_rerootings(geneTree,locusMapForRootingD):
+            numRootings+=1
+            geneTreeD=trees.parseTreeForDP(rooting,parasite=True)
+            for locusMapD,mapName in ((gtLocusMapD,"family locus map"),(widerLocusMapD,"locus map with a locus outside the tree")):
+                for problem in checkRooting(speciesTreeD,geneTreeD,tipMapD,locusMapD):
+                    numProblems+=1
+                    print("family seed {}, rooting {}, {}: {}".format(seed,rooting[0],mapName,problem))
+
+    print("{} rootings, {} cost vectors, {} differences".format(numRootings,len(costsL),numProblems))
+
+    if args.deepGenes>0:
+        deepProblemsL=checkDeepFamily(args.deepGenes)
+        for problem in deepProblemsL:
+            print("caterpillar with {} genes, {}".format(args.deepGenes,problem))
+        print("caterpillar with {} genes: {} failures".format(args.deepGenes,len(deepProblemsL)))
+        numProblems+=len(deepProblemsL)
+
+    if numProblems>0:
+        sys.exit(1)
@@ -0,0 +1,143 @@
+# checkpoint.py
+# Checkpoints of a reconciliation in progress, so that a family that
+# takes days (e.g. initFam000001.tre) can be resumed after a crash or
+# preemption rather than started again.
+
+# A checkpoint is an append-only file of pickled records. The first
+# record identifies the family and costs, and how the run numbers the
+# rootings and interns names (see checkpointKey).
+# Each later record is the result of scoring a range of rootings, as
+# returned by familiesDTLORstuff.scoreRootings, optionally with the DP
+# tables of the clades first computed while scoring it (the new entries
+# of the clade cache) and the engine they are for. Records are buffered
+# and written at most every interval seconds, so writing a checkpoint
+# costs little compared to the DP.
+
+# With the clade cache, the first rooting of a family computes about half
+# of all its clade tables, so when tables are saved they are also
+# checkpointed from within the DP of a rooting, as each gene edge is done
+# (see addClades). These 'clades' records hold tables but no rootings. A
+# run that is killed then loses at most about interval seconds of DP.
+
+import os, time, pickle, hashlib, itertools
+import resultCache
+
+## funcs
+
+def checkpointKey(familyKey,geneTree,geneSymbols,locusSymbols,speciesTree):
+    '''Key of the checkpoint of a family. familyKey (see
+resultCache.familyKey) identifies the inputs up to the order of the
+maps and the rooting and child order of the trees. But the saved
+results are indexed by rooting, and the saved tables by the ids of
+gene nodes and loci and the order of the host edges, so those are part
+of the key too: the rooted input geneTree (which sets the order of the
+rootings), the symbol tables of the gene tree and loci, and the host
+edges of speciesTree (a HostTreeIndex) in order.'''
+    hostName=speciesTree.symbols.name
+    partsL=[familyKey,
+            resultCache.flatTree(geneTree),
+            geneSymbols.namesL,
+            locusSymbols.namesL,
+            [hostName(edge) for edge in speciesTree.edges]]
+    return hashlib.sha256(repr(partsL).encode()).hexdigest()
+
+def readRecords(checkpointFN):
+    '''Return the records in checkpointFN. A last record that was only
+partly written (the run was killed while writing it) is removed from
+the file.'''
+    recordsL=[]
+    with open(checkpointFN,"r+b") as f:
+        end=0
+        while True:
+            try:
+                recordsL.append(pickle.load(f))
+            except (EOFError,pickle.UnpicklingError,ValueError,AttributeError,IndexError):
+                break
+            end=f.tell()
+        f.truncate(end)
+    return recordsL
+
+class Checkpoint:
+    '''Checkpoint file checkpointFN for the family identified by key,
+reconciled with engine. If saveTables, the DP tables of each clade are
+saved as well as the rooting results. Records are written to the file
+at most every interval seconds.'''
+
+    def __init__(self,checkpointFN,key,engine,saveTables=False,interval=60):
+        self.checkpointFN=checkpointFN
+        self.key=key
+        self.engine=engine
+        self.saveTables=saveTables
+        self.interval=interval
+        self.bufferL=[]
+        self.lastWrite=time.time()
+        self.numCladesSaved=0
+
+    def load(self,cladeCacheD=None):
+        '''Return the list of (start,end,result) for the ranges of rootings
+already scored, and add any saved clade tables to cladeCacheD. If the
+file is missing, or belongs to other inputs, start a new one.'''
+        recordsL=[]
+        if os.path.exists(self.checkpointFN):
+            recordsL=readRecords(self.checkpointFN)
+        if recordsL==[] or recordsL[0]!=('header',self.key):
+            with open(self.checkpointFN,"wb") as f:
+                pickle.dump(('header',self.key),f,protocol=pickle.HIGHEST_PROTOCOL)
+            recordsL=[]
+
+        doneL=[]
+        for record in recordsL[1:]:
+            kind,rangeT,result,engine,tablesL=record
+            if kind=='rootings':
+                doneL.append((rangeT[0],rangeT[1],result))
+            # clade tables are only any use to the engine that made them
+            if cladeCacheD is not None and engine==self.engine:
+                cladeCacheD.update(tablesL)
+        if cladeCacheD is not None:
+            self.numCladesSaved=len(cladeCacheD)
+        return doneL
+
+    def add(self,rangeT,result,cladeCacheD=None):
+        '''Record the result of scoring the rootings in range rangeT.
+cladeCacheD is the clade cache the rootings were scored with, whose
+new entries are saved if saveTables.'''
+        tablesL=[]
+        if self.saveTables and cladeCacheD is not None:
+            tablesL=self.newClades(cladeCacheD)
+        self.bufferL.append(('rootings',rangeT,result,self.engine,tablesL))
+        if time.time()-self.lastWrite>=self.interval:
+            self.flush()
+
+    def addClades(self,cladeCacheD):
+        '''Called by the DP each time it adds the tables of a clade to
+cladeCacheD (see DTLOR_DP.DP). If saveTables and the last write was at
+least interval seconds ago, the new entries are written, so a rooting
+in progress can be resumed.'''
+        if self.saveTables and time.time()-self.lastWrite>=self.interval:
+            self.bufferL.append(('clades',None,None,self.engine,self.newClades(cladeCacheD)))
+            self.flush()
+
+    def newClades(self,cladeCacheD):
+        '''The entries of cladeCacheD that haven't been saved yet.'''
+        # the cache is only added to, so the new entries are the last ones
+        # in insertion order
+        tablesL=list(itertools.islice(cladeCacheD.items(),self.numCladesSaved,None))
+        self.numCladesSaved=len(cladeCacheD)
+        return tablesL
+
+    def flush(self):
+        '''Write the buffered records to the file.'''
+        if self.bufferL!=[]:
+            with open(self.checkpointFN,"ab") as f:
+                for record in self.bufferL:
+                    pickle.dump(record,f,protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            self.bufferL=[]
+        self.lastWrite=time.time()
+
+    def remove(self):
+        '''Delete the checkpoint, once the reconciliation is done.'''
+        self.bufferL=[]
+        if os.path.exists(self.checkpointFN):
+            os.remove(self.checkpointFN)
@@ -1,4 +1,8 @@
-import trees, DTLOR_DP, random
+import trees, DTLOR_DP, DTLOR_DP_array, random, time, resultCache, checkpoint, instrument
+from multiprocessing import Pool, Value
+
+# DP engines that reconcile can use. Both have the same DP function.
+enginesD = {'dict': DTLOR_DP, 'array': DTLOR_DP_array}
 
 def reduceLocusMap(geneTree,locusMapD):
     '''Create a new locus map D with only entries for genes in geneTree.'''
@@ -8,35 +12,364 @@ def reduceLocusMap(geneTree,locusMapD):
         gtLocusMapD[leaf] = locusMapD[leaf]
     return gtLocusMapD
         
-def reconcile(argT):
-    '''Reconcile a single gene tree.'''
+class SymbolTable:
+    '''Interns names (node names, gene numbers, loci) as the ints 0, 1,
+2, ... The DP works on interned trees and maps, so that its keys are
+tuples of small ints, and names are only looked up again for output.'''
 
-    speciesTree,geneTree,tipMapD,gtLocusMapD,locusMapForRootingD,D,T,L,O,R = argT
+    def __init__(self,namesL=()):
+        self.idD={}
+        self.namesL=[]
+        for name in namesL:
+            self.intern(name)
+
+    def intern(self,name):
+        '''Return the id of name, giving it the next id if it is new.'''
+        i=self.idD.get(name)
+        if i is None:
+            i=len(self.namesL)
+            self.idD[name]=i
+            self.namesL.append(name)
+        return i
+
+    def name(self,i):
+        '''Return the name with id i.'''
+        return self.namesL[i]
+
+def internTreeForDP(treeD,symbols):
+    '''Return a copy of a tree from trees.parseTreeForDP with each edge
+and node name replaced by its id in symbols.'''
+    def ID(name):
+        return None if name is None else symbols.intern(name)
+    internedD={}
+    for edge,(top,bottom,left,right) in treeD.items():
+        internedD[ID(edge)]=(ID(top),ID(bottom),ID(left),ID(right))
+    return internedD
+
+def internMap(mapD,keySymbols,valueSymbols):
+    '''Return a copy of mapD with keys and values replaced by their ids.'''
+    return {keySymbols.intern(k):valueSymbols.intern(v) for k,v in mapD.items()}
+
+def externMPR(MPR,geneSymbols,hostSymbols,locusSymbols):
+    '''Map the ids in an MPR from the DP back to names. In a mapping node
+(gene node, host node, locus), the locus "*" for no locus isn't
+interned.'''
+    def extern(mapping):
+        if mapping is None:
+            return None
+        ep,eh,l=mapping
+        if l!="*":
+            l=locusSymbols.name(l)
+        return (geneSymbols.name(ep),hostSymbols.name(eh),l)
+    return {extern(m):(eType,extern(eLeft),extern(eRight)) for m,(eType,eLeft,eRight) in MPR.items()}
+
+def speciesTreeIndex(speciesTree):
+    '''Convert a species tree to the HostTreeIndex that the DP engines
+use, with its node names interned in the index's symbols. A caller
+reconciling many families with the same species tree can do this once
+and pass the index to reconcile in place of the tree.'''
+    hostSymbols=SymbolTable()
+    speciesTreeD=internTreeForDP(trees.parseTreeForDP(speciesTree,parasite=False),hostSymbols)
+    return DTLOR_DP.HostTreeIndex(speciesTreeD,hostSymbols)
+
+def geneTreeForDP(geneTree,geneSymbols):
+    '''Convert a rooted gene tree to the interned format the DP uses.'''
+    return internTreeForDP(trees.parseTreeForDP(geneTree,parasite=True),geneSymbols)
+
+def scoreRootings(rootingsL,speciesTree,geneSymbols,tipMapD,gtLocusMapD,D,T,L,O,R,engine,cladeCacheD,verbose,cutoff=float('inf'),cladeDone=None,sharedBest=None):
+    '''Score each rooting in rootingsL without tracking events. Return
+(best_score,numBest,bestIndex), where numBest is the number of
+rootings with the best score and bestIndex is the index in rootingsL
+of one of them, sampled uniformly. speciesTree, tipMapD and
+gtLocusMapD are interned, and geneSymbols interns the gene tree.
+cutoff is a score already reached by other rootings; rootings that
+can't tie it are not scored exactly. cladeDone is passed to the DP as
+clade_done (see DTLOR_DP.DP). sharedBest is an optional
+multiprocessing.Value with the best score found so far by all the
+processes scoring rootings of the family. It is used as a cutoff, and
+lowered when a rooting here beats it.'''
+    # The rootings share all but a few clades, so the DP tables for
+    # each clade are kept in cladeCacheD and computed only once. One of
+    # the rootings with the best score is sampled uniformly by reservoir
+    # sampling, so the tied rootings never need to be kept.
+    # The DP of a rooting stops as soon as it can't tie the best score
+    # so far (branch and bound). The first rooting from
+    # get_all_rerootings is the midpoint rooting of the input tree,
+    # which usually gives a good score early.
+    best_score=float('inf')
+    numBest=0
+    bestIndex=None
+    DP=enginesD[engine].DP
+    for index,geneTree in enumerate(rootingsL):
+        if instrument.recorder is not None:
+            startTime=time.perf_counter()
+            startCells=instrument.recorder.cells
+        geneTreeD=geneTreeForDP(geneTree,geneSymbols) # gene tree to right format
+        bound=min(best_score,cutoff)
+        if sharedBest is not None:
+            bound=min(bound,sharedBest.value)
+        _,cost=DP(speciesTree, geneTreeD, tipMapD, gtLocusMapD, D, T, L, O, R, cladeCacheD, track_events=False, cutoff=bound, clade_done=cladeDone)
+        pruned=cost > bound + DTLOR_DP.Epsilon
+        if instrument.recorder is not None:
+            instrument.recorder.addRooting(time.perf_counter()-startTime,instrument.recorder.cells-startCells,cost,pruned)
+        if sharedBest is not None and not pruned and cost < sharedBest.value:
+            with sharedBest.get_lock():
+                sharedBest.value=min(sharedBest.value,cost)
+        if verbose:
+            if pruned:
+                # cost may only be a lower bound
+                print("Min Cost: at least {}".format(cost))
+            else:
+                print("Min Cost: {}".format(cost))
+        if cost < best_score - DTLOR_DP.Epsilon:
+            # If the score is better than current best
+            # Update best score and restart the sample
+            best_score=cost
+            numBest=1
+            bestIndex=index
+        elif cost <= best_score + DTLOR_DP.Epsilon:
+            # Keep this rooting with probability 1/numBest
+            numBest+=1
+            if random.randrange(numBest)==0:
+                bestIndex=index
+    return best_score,numBest,bestIndex
+
+# The inputs of scoreRootings in each worker process, set by
+# initRootingWorker. workerCladeCacheD is kept between the chunks of
+# rootings a worker gets.
+workerArgD = {}
+workerCladeCacheD = {}
+
+def initRootingWorker(allRootingsL,speciesTree,geneSymbols,tipMapD,gtLocusMapD,D,T,L,O,R,engine,verbose,instrumented,cladeCacheD,sharedBest):
+    '''Store the inputs that all the chunks of rootings share, so they are
+sent to each worker once rather than with every chunk. If instrumented,
+each chunk is measured (see instrument.py). The worker's clade cache
+starts with the tables in cladeCacheD, and sharedBest is the best score
+shared by all the workers (see scoreRootings).'''
+    workerArgD['allRootingsL']=allRootingsL
+    workerArgD['argT']=(speciesTree,geneSymbols,tipMapD,gtLocusMapD,D,T,L,O,R,engine)
+    workerArgD['verbose']=verbose
+    workerArgD['instrumented']=instrumented
+    workerArgD['sharedBest']=sharedBest
+    workerCladeCacheD.clear()
+    workerCladeCacheD.update(cladeCacheD)
+    # forked workers start with the same random state
+    random.seed()
+
+def scoreRootingChunk(rangeT):
+    '''Score the rootings in allRootingsL[start:end] in a worker. Returns
+rangeT, the output of scoreRootings, with bestIndex an index in
+allRootingsL, and the instrument report for the chunk (or None).'''
+    start,end=rangeT
+    rootingsL=workerArgD['allRootingsL'][start:end]
+    if workerArgD['instrumented']:
+        instrument.enable()
+    best_score,numBest,bestIndex=scoreRootings(rootingsL,*workerArgD['argT'],workerCladeCacheD,workerArgD['verbose'], \
+                                               sharedBest=workerArgD['sharedBest'])
+    reportD=None
+    if workerArgD['instrumented']:
+        reportD=instrument.disable().report()
+    return rangeT,(best_score,numBest,start+bestIndex),reportD
+
+def mergeSamples(sampleT,chunkSampleT):
+    '''Combine two samples of a best rooting, each (best_score,numBest,
+bestIndex) as returned by scoreRootings, so that every tied rooting is
+equally likely to be chosen.'''
+    best_score,numBest,bestIndex=sampleT
+    chunk_score,chunkNumBest,chunkIndex=chunkSampleT
+    if chunk_score < best_score - DTLOR_DP.Epsilon:
+        return chunkSampleT
+    elif chunk_score <= best_score + DTLOR_DP.Epsilon:
+        numBest+=chunkNumBest
+        if random.randrange(numBest)<chunkNumBest:
+            bestIndex=chunkIndex
+    return best_score,numBest,bestIndex
+
+def rootingRanges(indicesL,chunkSize):
+    '''Split the sorted list of rooting indices indicesL into ranges
+(start,end) of consecutive indices, each at most chunkSize long.'''
+    rangesL=[]
+    for index in indicesL:
+        if rangesL!=[] and rangesL[-1][1]==index and index-rangesL[-1][0]<chunkSize:
+            rangesL[-1]=(rangesL[-1][0],index+1)
+        else:
+            rangesL.append((index,index+1))
+    return rangesL
 
-    # species tree to right format
-    speciesTree=trees.parseTreeForDP(speciesTree,parasite=False)
+def prepareFamily(speciesTree,geneTree,tipMapD,gtLocusMapD,locusMapForRootingD):
+    '''Do the work for a family that doesn't depend on the costs. Returns
+the species tree as a HostTreeIndex, the list of rootings of geneTree,
+the symbol tables for gene nodes and loci, and the interned tip and
+locus maps.'''
+    # species tree to right format, unless the caller already did
+    # this (see speciesTreeIndex)
+    if not isinstance(speciesTree,DTLOR_DP.HostTreeIndex):
+        speciesTree=speciesTreeIndex(speciesTree)
 
     # get all possible rootings
+    startTime=instrument.start()
     allRootingsL=trees.get_all_rerootings(geneTree, locusMapForRootingD)
+    instrument.stop("rootings",startTime)
     if allRootingsL==[]:  #all rerooting not valid (all nodes have the same loc)
         allRootingsL=[geneTree]
 
-    # try all rootings and record the ones and their
-    # solutions with the best scores
-    best_score=float('inf')
-    bestMPRs=[]
-    for geneTree in allRootingsL:
-        geneTreeD=trees.parseTreeForDP(geneTree,parasite=True) # gene tree to right format
-        MPR,cost=DTLOR_DP.DP(speciesTree, geneTreeD, tipMapD, gtLocusMapD, D, T, L, O, R)
-        print("Min Cost: {}".format(cost))
-        if cost < best_score: 
-            # If the score is better than current best
-            # Update best score, clear record and add new record
-            best_score=cost
-            bestMPRs=[(geneTree, MPR)]
-        elif cost==best_score:
-            bestMPRs.append((geneTree,MPR))
+    # intern everything the DP sees
+    geneSymbols=SymbolTable(trees.nodeList(geneTree)+["p_root"])
+    # loci get ids in sorted order, so that they don't depend on the
+    # order of the locus map
+    locusSymbols=SymbolTable(sorted(set(gtLocusMapD.values()),key=repr))
+    tipMapD=internMap(tipMapD,geneSymbols,speciesTree.symbols)
+    gtLocusMapD=internMap(gtLocusMapD,geneSymbols,locusSymbols)
+    return speciesTree,allRootingsL,geneSymbols,locusSymbols,tipMapD,gtLocusMapD
+
+def reconcile(argT,engine='dict',verbose=True,numProcesses=1,resultCacheO=None,checkpointFN=None,checkpointTables=False,checkpointInterval=60):
+    '''Reconcile a single gene tree. Returns a rooting of it with the
+best score, and an MPR of that rooting sampled uniformly from all its
+MPRs. engine is a key of enginesD selecting the DP implementation. If verbose, print the cost of each
+rooting. With numProcesses > 1 the rootings are scored in a pool of
+that many processes. This only pays off with that many free CPUs and
+a family with many rootings (hundreds or more): each worker
+recomputes the clades of its own rootings that aren't in the first
+rooting, and the pool takes time to start. On one CPU, or when
+families are already reconciled in parallel (as in runDTLOR_batch.py),
+use 1. If resultCacheO (a resultCache.ResultCache) is
+given, the result is looked up there first, and stored there if it
+wasn't. If checkpointFN is given, the scores of the rootings (and if
+checkpointTables, the DP tables of their clades, also from within the
+DP of a rooting) are saved there as they are computed, at most every
+checkpointInterval seconds, and a run with the same inputs picks up
+from them. With numProcesses > 1 only the tables of the first rooting,
+which is scored before the pool starts, are saved. The file is removed
+once the reconciliation is done. If instrumentation is on (see instrument.py),
+the time of each phase and rooting is recorded in instrument.recorder.'''
+
+    speciesTree,geneTree,tipMapD,gtLocusMapD,locusMapForRootingD,D,T,L,O,R = argT
+
+    if resultCacheO is not None or checkpointFN is not None:
+        key=resultCache.familyKey(speciesTree,geneTree,tipMapD,gtLocusMapD,(D,T,L,O,R))
+    if resultCacheO is not None:
+        result=resultCacheO.get(key)
+        if result is not None:
+            _,flatRootedGeneTree,optMPR=result
+            return resultCache.unflatTree(flatRootedGeneTree),optMPR
+
+    speciesTree,allRootingsL,geneSymbols,locusSymbols,tipMapD,gtLocusMapD = \
+        prepareFamily(speciesTree,geneTree,tipMapD,gtLocusMapD,locusMapForRootingD)
+
+    parallel = numProcesses>1 and len(allRootingsL)>1
+    cladeCacheD={}
 
-    #sample one MPR from the MPRs for this specific unrooted tree
-    optRootedGeneTree, optMPR = random.choice(bestMPRs) 
+    # the rootings scored before the last checkpoint
+    sampleT=(float('inf'),0,None)
+    doneS=set()
+    checkpointO=None
+    if checkpointFN is not None:
+        checkpointKey=checkpoint.checkpointKey(key,geneTree,geneSymbols,locusSymbols,speciesTree)
+        checkpointO=checkpoint.Checkpoint(checkpointFN,checkpointKey,engine,checkpointTables,checkpointInterval)
+        for start,end,chunkSampleT in checkpointO.load(cladeCacheD):
+            sampleT=mergeSamples(sampleT,chunkSampleT)
+            doneS.update(range(start,end))
+        if verbose and doneS:
+            print("Resuming from checkpoint: {} of {} rootings done".format(len(doneS),len(allRootingsL)))
+    todoL=[index for index in range(len(allRootingsL)) if index not in doneS]
+
+    # Without a pool, all the rootings are scored here. With one, the
+    # first rooting to do is scored here before the pool starts. Its cost
+    # is then a cutoff for all the workers, and they start with its clade
+    # tables, which are most of the clades of any rooting, instead of each
+    # computing them again.
+    serialL=todoL[:1] if parallel else todoL
+    # With a checkpoint, the result of each rooting is recorded as soon
+    # as it is scored. The tables, if they are saved, are also saved from
+    # within the DP of a rooting, as its clades are done.
+    cladeDone=None
+    if checkpointO:
+        cladeDone=lambda: checkpointO.addClades(cladeCacheD)
+    rangesL=rootingRanges(serialL,1 if checkpointO else len(allRootingsL))
+    for start,end in rangesL:
+        best_score,numBest,bestIndex=scoreRootings(allRootingsL[start:end],speciesTree,geneSymbols,tipMapD,gtLocusMapD,D,T,L,O,R,engine,cladeCacheD,verbose,sampleT[0],cladeDone)
+        chunkSampleT=(best_score,numBest,start+bestIndex)
+        sampleT=mergeSamples(sampleT,chunkSampleT)
+        if checkpointO:
+            checkpointO.add((start,end),chunkSampleT,cladeCacheD)
+    if parallel and len(todoL)>1:
+        # Neighbouring rootings share the most clades, so each worker
+        # gets contiguous chunks. There are a few chunks per worker to
+        # balance the load. The workers share the best score so far
+        # through sharedBest, so each prunes with the others' results.
+        chunkSize=max(1,-(-len(allRootingsL)//(4*numProcesses)))
+        rangesL=rootingRanges(todoL[1:],chunkSize)
+        sharedBest=Value('d',sampleT[0])
+        initargs=(allRootingsL,speciesTree,geneSymbols,tipMapD,gtLocusMapD,D,T,L,O,R,engine,verbose,instrument.recorder is not None, \
+                  cladeCacheD,sharedBest)
+        with Pool(processes=numProcesses,initializer=initRootingWorker,initargs=initargs) as p:
+            for rangeT,chunkSampleT,reportD in p.imap_unordered(scoreRootingChunk,rangesL):
+                sampleT=mergeSamples(sampleT,chunkSampleT)
+                if reportD is not None and instrument.recorder is not None:
+                    instrument.recorder.merge(reportD)
+                if checkpointO:
+                    checkpointO.add(rangeT,chunkSampleT)
+    if checkpointO:
+        checkpointO.flush()
+    best_score,numBest,bestIndex=sampleT
+    optRootedGeneTree=allRootingsL[bestIndex]
+
+    # sample one MPR of the chosen rooting uniformly, from the graph of
+    # all its MPRs
+    geneTreeD=geneTreeForDP(optRootedGeneTree,geneSymbols)
+    MPRGraphO,_=enginesD[engine].DP(speciesTree, geneTreeD, tipMapD, gtLocusMapD, D, T, L, O, R, cladeCacheD, graph=True)
+    optMPR=externMPR(MPRGraphO.sample()[0],geneSymbols,speciesTree.symbols,locusSymbols)
+    if resultCacheO is not None:
+        resultCacheO.put(key,(best_score,resultCache.flatTree(optRootedGeneTree),optMPR))
+    if checkpointO:
+        checkpointO.remove()
     return optRootedGeneTree,optMPR
+
+def reconcileSweep(argT,costsL,withMPR=False):
+    '''Reconcile a single gene tree once for each cost vector (D,T,L,O,R)
+in costsL. argT is as for reconcile, without the costs. The rootings,
+parsed trees and maps are shared by all the cost vectors, and each
+rooting is scored for all of them at once by DTLOR_DP_array.DP_sweep.
+Returns a list with (cost, rooted gene tree, MPR) for each cost vector,
+where the MPR is None unless withMPR.'''
+
+    speciesTree,geneTree,tipMapD,gtLocusMapD,locusMapForRootingD = argT
+    speciesTree,allRootingsL,geneSymbols,locusSymbols,tipMapD,gtLocusMapD = \
+        prepareFamily(speciesTree,geneTree,tipMapD,gtLocusMapD,locusMapForRootingD)
+
+    # As in scoreRootings, with the best score, number of ties and
+    # sampled rooting kept for each cost vector. The DP of a rooting
+    # only stops early once no cost vector can tie its best score.
+    numCosts=len(costsL)
+    best_scores=[float('inf')]*numCosts
+    numBestL=[0]*numCosts
+    bestIndexL=[None]*numCosts
+    cladeCacheD={}
+    for index,geneTree in enumerate(allRootingsL):
+        geneTreeD=geneTreeForDP(geneTree,geneSymbols)
+        _,costs=DTLOR_DP_array.DP_sweep(speciesTree, geneTreeD, tipMapD, gtLocusMapD, costsL, cladeCacheD, cutoff=best_scores)
+        for k,cost in enumerate(costs):
+            if cost < best_scores[k] - DTLOR_DP.Epsilon:
+                best_scores[k]=cost
+                numBestL[k]=1
+                bestIndexL[k]=index
+            elif cost <= best_scores[k] + DTLOR_DP.Epsilon:
+                numBestL[k]+=1
+                if random.randrange(numBestL[k])==0:
+                    bestIndexL[k]=index
+
+    MPRL=[None]*numCosts
+    if withMPR:
+        # one traceback per cost vector, on the tables of the rooting
+        # chosen for it. The tables of a rooting are filled for all the
+        # cost vectors (so the clade cache can be shared), but only the
+        # cost vectors that chose it are traced back.
+        for index in set(bestIndexL):
+            tracedL=[k for k in range(numCosts) if bestIndexL[k]==index]
+            geneTreeD=geneTreeForDP(allRootingsL[index],geneSymbols)
+            MPRGraphL,_=DTLOR_DP_array.DP_sweep(speciesTree, geneTreeD, tipMapD, gtLocusMapD, costsL, cladeCacheD, track_events=True, traced=tracedL, graph=True)
+            for k in tracedL:
+                MPRL[k]=externMPR(MPRGraphL[k].sample()[0],geneSymbols,speciesTree.symbols,locusSymbols)
+
+    return [(float(best_scores[k]),allRootingsL[bestIndexL[k]],MPRL[k]) for k in range(numCosts)]
+
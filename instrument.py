@@ -0,0 +1,122 @@
+# instrument.py
+# Opt-in timing and throughput measurements of reconciliations, to see
+# where the time goes for a family.
+
+# Instrumentation is off unless enable() is called. While it is off,
+# recorder is None and each instrumented place in the code only checks
+# that, so it costs next to nothing. While it is on, the Recorder keeps:
+#   phases    total seconds and number of calls of each phase (loading
+#             the trees and maps, generating the rootings, filling the
+#             DP tables, the null (no syntenic location) step, traceback).
+#             The phases don't overlap, e.g. the DP fill time doesn't
+#             include the null step.
+#   rootings  for each rooting scored, its wall time, the number of DP
+#             table cells computed for it (cells taken from the clade
+#             cache aren't counted) and cells per second
+#   counts    for calls like find_min_events, the number of calls and the
+#             total and largest length of the event lists they return
+# report() returns all of this as a dict that can be written as JSON.
+
+import json, time
+from contextlib import contextmanager
+
+# the active Recorder, or None if instrumentation is off
+recorder = None
+
+## funcs
+
+def enable():
+    '''Turn instrumentation on with a new Recorder, and return it.'''
+    global recorder
+    recorder = Recorder()
+    return recorder
+
+def disable():
+    '''Turn instrumentation off, and return the Recorder that was active.'''
+    global recorder
+    oldRecorder = recorder
+    recorder = None
+    return oldRecorder
+
+def start():
+    '''Start timing a phase. Returns the start time, or None if
+instrumentation is off.'''
+    if recorder is None:
+        return None
+    return time.perf_counter()
+
+def stop(phase,startTime):
+    '''Add the time since startTime (from start) to phase, and return it
+(None if instrumentation is off). A phase timed inside another, like the
+null step inside the DP fill, is kept out of the outer one by moving the
+outer start time forward by what this returns.'''
+    if recorder is not None and startTime is not None:
+        seconds = time.perf_counter()-startTime
+        recorder.addPhase(phase,seconds)
+        return seconds
+    return None
+
+@contextmanager
+def timed(phase):
+    '''Context manager timing the code in it as phase.'''
+    startTime = start()
+    try:
+        yield
+    finally:
+        stop(phase,startTime)
+
+class Recorder:
+    '''Measurements of one or more reconciliations.'''
+
+    def __init__(self):
+        self.phasesD = {}
+        self.rootingsL = []
+        self.countsD = {}
+        # DP table cells computed, see DTLOR_DP.DP
+        self.cells = 0
+
+    def addPhase(self,phase,seconds,calls=1):
+        '''Add seconds to the time of phase.'''
+        total,numCalls = self.phasesD.get(phase,(0.0,0))
+        self.phasesD[phase] = (total+seconds,numCalls+calls)
+
+    def addRooting(self,seconds,cells,cost,pruned):
+        '''Record a rooting that took seconds, and computed cells DP table
+cells. If pruned, its DP stopped early and cost is a lower bound.'''
+        self.rootingsL.append({'seconds':seconds,
+                               'cells':cells,
+                               'cellsPerSec':cells/seconds if seconds>0 else None,
+                               'cost':float(cost),
+                               'pruned':pruned})
+
+    def count(self,name,length):
+        '''Count a call of name that returned an event list of length.'''
+        calls,total,largest = self.countsD.get(name,(0,0,0))
+        self.countsD[name] = (calls+1,total+length,max(largest,length))
+
+    def merge(self,reportD):
+        '''Add in the measurements in reportD, the report of another
+Recorder (e.g. from a worker process).'''
+        for phase,D in reportD['phases'].items():
+            self.addPhase(phase,D['seconds'],D['calls'])
+        self.rootingsL.extend(reportD['rootings'])
+        for name,D in reportD['counts'].items():
+            calls,total,largest = self.countsD.get(name,(0,0,0))
+            self.countsD[name] = (calls+D['calls'],total+D['totalLength'],max(largest,D['maxLength']))
+        self.cells += reportD['cells']
+
+    def report(self):
+        '''Return the measurements as a dict of plain values.'''
+        return {'phases':{phase:{'seconds':total,'calls':calls} for phase,(total,calls) in self.phasesD.items()},
+                'rootings':self.rootingsL,
+                'counts':{name:{'calls':calls,'totalLength':total,'maxLength':largest} \
+                          for name,(calls,total,largest) in self.countsD.items()},
+                'cells':self.cells}
+
+    def write(self,fn,**extraD):
+        '''Append the report to fn as one line of JSON, with the entries
+of extraD (e.g. the family name) added.'''
+        reportD = dict(extraD)
+        reportD.update(self.report())
+        with open(fn,"a") as f:
+            f.write(json.dumps(reportD)+"\n")
@@ -0,0 +1,130 @@
+# mapIndex.py
+# On-disk index of the tip map (gene -> species) and the locus map
+# (gene -> syntenic location). It is built once from the tsv files, and
+# then memory-mapped, so that reconciling a family only reads the entries
+# for the genes in its gene tree, however many genes the maps have.
+
+# Each map is stored as two arrays in the index directory:
+#   <name>.npy        for each gene number, the position of its value in
+#                     the value table (-1 for genes not in the map)
+#   <name>Values.npy  the table of distinct values, as utf-8 bytes
+# and a record of the tsv file it was built from:
+#   <name>Source.json the absolute path, size and modification time of
+#                     the tsv file. The index is rebuilt if any of these
+#                     differ from the tsv file it is loaded for.
+
+import os, json, tempfile, operator
+import numpy as np
+
+mapNamesL = ['tipMap', 'locusMap']
+
+## funcs
+
+def buildOneMap(mapFN,indexDir,name):
+    '''Index the map in mapFN (lines of gene<tab>value, with integer
+genes) as the arrays for name in indexDir.'''
+    # taken before reading, so a change to mapFN while it is read makes
+    # the index stale
+    sourceD=sourceRecord(mapFN)
+    geneL=[]
+    valuePosL=[]
+    valuePosD={}
+    with open(mapFN,"r") as f:
+        for s in f:
+            L=s.rstrip().split("\t")
+            geneL.append(int(L[0]))
+            valuePosL.append(valuePosD.setdefault(L[1],len(valuePosD)))
+
+    positions=np.full(max(geneL,default=-1)+1,-1,dtype=np.int32)
+    positions[geneL]=valuePosL
+    values=np.array([value.encode() for value in valuePosD],dtype=bytes)
+
+    # The source record is removed first and written last, so it only
+    # matches a tsv file once the arrays built from it are all in place
+    sourcePath=os.path.join(indexDir,name+"Source.json")
+    try:
+        os.remove(sourcePath)
+    except FileNotFoundError:
+        pass
+    for arr,fn in ((values,name+"Values.npy"),(positions,name+".npy")):
+        writeAtomically(indexDir,fn,lambda f: np.save(f,arr))
+    writeAtomically(indexDir,name+"Source.json",lambda f: f.write(json.dumps(sourceD).encode()))
+
+def writeAtomically(indexDir,fn,writeFunc):
+    '''Write fn in indexDir by calling writeFunc on a binary file. It is
+written to a temporary file of its own first and then moved into place,
+so a partly written file is never used, and builds running at the same
+time don't write to the same file.'''
+    fd,tempPath=tempfile.mkstemp(dir=indexDir,prefix=fn,suffix=".tmp")
+    try:
+        with os.fdopen(fd,"wb") as f:
+            writeFunc(f)
+        os.replace(tempPath,os.path.join(indexDir,fn))
+    except BaseException:
+        os.remove(tempPath)
+        raise
+
+def sourceRecord(mapFN):
+    '''The absolute path, size and modification time of mapFN.'''
+    st=os.stat(mapFN)
+    return {'path':os.path.abspath(mapFN),'size':st.st_size,'mtime':st.st_mtime_ns}
+
+def isStale(mapFN,indexDir,name):
+    '''True if the index for name is missing, or was built from a file
+other than mapFN, or from mapFN as it was before it last changed.'''
+    if not all(os.path.exists(os.path.join(indexDir,fn)) for fn in (name+".npy",name+"Values.npy")):
+        return True
+    try:
+        with open(os.path.join(indexDir,name+"Source.json"),"r") as f:
+            builtFromD=json.load(f)
+    except (OSError,ValueError):
+        return True
+    return builtFromD != sourceRecord(mapFN)
+
+def loadMapIndex(tipMapFN,locusMapFN,indexDir):
+    '''Return the MapIndex in indexDir, first building the index for any
+map that wasn't built from its tsv file as it is now (see isStale).'''
+    os.makedirs(indexDir,exist_ok=True)
+    for mapFN,name in zip((tipMapFN,locusMapFN),mapNamesL):
+        if isStale(mapFN,indexDir,name):
+            buildOneMap(mapFN,indexDir,name)
+    return MapIndex(indexDir)
+
+class MapIndex:
+    '''Memory-mapped tip map and locus map, as written by buildOneMap.'''
+
+    def __init__(self,indexDir):
+        self.mapsD={}
+        for name in mapNamesL:
+            positions=np.load(os.path.join(indexDir,name+".npy"),mmap_mode='r')
+            values=np.load(os.path.join(indexDir,name+"Values.npy"),mmap_mode='r')
+            self.mapsD[name]=(positions,values)
+
+    def lookup(self,name,genesL):
+        '''Return a dict with the values of the genes in genesL in map name.
+As in runDTLOR_DP.loadD, values that are all digits are converted to int.
+As with the dict from loadD, a gene that isn't in the map, including
+one whose name isn't an integer, raises a KeyError.'''
+        positions,values=self.mapsD[name]
+        D={}
+        for gene in genesL:
+            try:
+                i = operator.index(gene)
+            except TypeError:
+                raise KeyError(gene) from None
+            pos = positions[i] if 0 <= i < len(positions) else -1
+            if pos == -1:
+                raise KeyError(gene)
+            value=values[pos].decode()
+            if value.isdigit():
+                value=int(value)
+            D[gene]=value
+        return D
+
+    def tipMap(self,genesL):
+        '''Tip map (gene -> species) for the genes in genesL.'''
+        return self.lookup('tipMap',genesL)
+
+    def locusMap(self,genesL):
+        '''Locus map (gene -> syntenic location) for the genes in genesL.'''
+        return self.lookup('locusMap',genesL)
@@ -0,0 +1,171 @@
+# resultCache.py
+# Persistent cache of reconciliation results, so that rerunning families
+# whose inputs haven't changed costs one hash and one lookup.
+
+# Results are keyed by a hash of everything that determines them (see
+# familyKey). They are stored in an sqlite database, which several
+# processes can use at once, e.g. the workers of runDTLOR_batch.py. When
+# the stored results get bigger than the size limit, the least recently
+# used ones are evicted.
+
+# A result is (cost, rooted gene tree, MPR), with the tree as a list
+# from flatTree. Note that reconcile samples one of the optimal rootings
+# and MPRs at random, so a cached result is the sample from the run that
+# stored it.
+
+import os, time, pickle, hashlib, sqlite3
+import trees
+
+## funcs
+
+def unrootedEdges(geneTree):
+    '''Return the edges of geneTree as an unrooted tree, as a sorted list
+of sorted pairs of node names. The root of geneTree has degree two, so
+it is removed and its children are joined.'''
+    edgesL=[(geneTree[1][0],geneTree[2][0])]
+    for child in (geneTree[1],geneTree[2]):
+        for subtree in trees.iterSubtrees(child):
+            if subtree[1]!=():
+                edgesL.append((subtree[0],subtree[1][0]))
+                edgesL.append((subtree[0],subtree[2][0]))
+    return sorted(tuple(sorted(map(repr,edge))) for edge in edgesL)
+
+def speciesTreeChildren(speciesTree):
+    '''Return the name of the root of a species tree, and a dict from the
+name of each node to the names of its children (() for a tip). The
+species tree is either a tuple tree or the HostTreeIndex from
+familiesDTLORstuff.speciesTreeIndex.'''
+    if isinstance(speciesTree,tuple):
+        childrenD={}
+        for subtree in trees.iterSubtrees(speciesTree):
+            childrenD[subtree[0]]=() if subtree[1]==() else (subtree[1][0],subtree[2][0])
+        return speciesTree[0],childrenD
+    if speciesTree.symbols is None:
+        raise ValueError("The HostTreeIndex has no symbols, so the names of its nodes are unknown. Make it with familiesDTLORstuff.speciesTreeIndex.")
+    name=speciesTree.symbols.name
+    vertexNamesL=[name(vertex) for vertex in speciesTree.vertices]
+    childrenD={}
+    for i,vertexName in enumerate(vertexNamesL):
+        if speciesTree.is_tip[i]:
+            childrenD[vertexName]=()
+        else:
+            childrenD[vertexName]=(vertexNamesL[speciesTree.left[i]],vertexNamesL[speciesTree.right[i]])
+    return vertexNamesL[speciesTree.index[speciesTree.root]],childrenD
+
+def speciesTreeKey(speciesTree):
+    '''Canonical string for a species tree, either a tuple tree or the
+HostTreeIndex from familiesDTLORstuff.speciesTreeIndex. It is a newick
+string with the children of each node sorted, so the same tree gives
+the same string in either form.'''
+    root,childrenD=speciesTreeChildren(speciesTree)
+    # children before parents
+    preorderL=[]
+    stack=[root]
+    while stack:
+        node=stack.pop()
+        preorderL.append(node)
+        stack.extend(childrenD[node])
+    newickD={}
+    for node in reversed(preorderL):
+        childrenL=sorted(newickD.pop(child) for child in childrenD[node])
+        if childrenL==[]:
+            newickD[node]=repr(node)
+        else:
+            newickD[node]="("+",".join(childrenL)+")"+repr(node)
+    return newickD[root]+";"
+
+def flatTree(tree):
+    '''The nodes of a tuple tree in preorder, each as (name, branch
+length, is a tip). Pickling a tuple tree recurses once per level, which
+fails for deep trees, so results hold their trees in this form.'''
+    return [(subtree[0],subtree[3],subtree[1]==()) for subtree in trees.iterSubtrees(tree)]
+
+def unflatTree(nodesL):
+    '''The tuple tree with the nodes nodesL from flatTree.'''
+    # In reverse preorder, the right subtree of a node is built before
+    # its left subtree, and both before the node.
+    subtreesL=[]
+    for name,branchLen,isTip in reversed(nodesL):
+        if isTip:
+            subtreesL.append((name,(),(),branchLen))
+        else:
+            left=subtreesL.pop()
+            right=subtreesL.pop()
+            subtreesL.append((name,left,right,branchLen))
+    return subtreesL[0]
+
+def familyKey(speciesTree,geneTree,tipMapD,gtLocusMapD,costsT):
+    '''Hash of the inputs of reconcile for one family: the unrooted gene
+tree (with its node names, which the MPR refers to), its tip map and
+locus map, the species tree and the costs (D,T,L,O,R).'''
+    partsL=[unrootedEdges(geneTree),
+            sorted((repr(k),repr(v)) for k,v in tipMapD.items()),
+            sorted((repr(k),repr(v)) for k,v in gtLocusMapD.items()),
+            speciesTreeKey(speciesTree),
+            repr(tuple(costsT))]
+    return hashlib.sha256(repr(partsL).encode()).hexdigest()
+
+class ResultCache:
+    '''Reconciliation results stored in the sqlite database dbFN, keeping
+at most about maxBytes of pickled results.'''
+
+    def __init__(self,dbFN,maxBytes=1<<30):
+        self.dbFN=dbFN
+        self.maxBytes=maxBytes
+        self.conn=None
+        self.pid=None
+
+    def connection(self):
+        '''The connection for this process. A connection can't be used
+across a fork, so each worker process opens its own.'''
+        if self.conn is None or self.pid!=os.getpid():
+            self.conn=sqlite3.connect(self.dbFN,timeout=60,isolation_level=None)
+            self.pid=os.getpid()
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB, size INTEGER, lastUsed REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS resultsLastUsed ON results (lastUsed)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+        return self.conn
+
+    def __getstate__(self):
+        # send only the file name and size limit to worker processes
+        return {'dbFN':self.dbFN,'maxBytes':self.maxBytes,'conn':None,'pid':None}
+
+    def get(self,key):
+        '''Return the result stored under key, or None.'''
+        conn=self.connection()
+        row=conn.execute("SELECT value FROM results WHERE key=?",(key,)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE results SET lastUsed=? WHERE key=?",(time.time(),key))
+        return pickle.loads(row[0])
+
+    def put(self,key,result):
+        '''Store result under key, then evict the least recently used
+results until the total size is within maxBytes.'''
+        value=pickle.dumps(result,protocol=pickle.HIGHEST_PROTOCOL)
+        conn=self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row=conn.execute("SELECT size FROM results WHERE key=?",(key,)).fetchone()
+            total=self.totalSize(conn)-(row[0] if row else 0)+len(value)
+            conn.execute("INSERT OR REPLACE INTO results VALUES (?,?,?,?)",(key,value,len(value),time.time()))
+            while total>self.maxBytes:
+                oldKey,size=conn.execute("SELECT key,size FROM results ORDER BY lastUsed LIMIT 1").fetchone()
+                conn.execute("DELETE FROM results WHERE key=?",(oldKey,))
+                total-=size
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('totalSize',?)",(total,))
+            conn.execute("COMMIT")
+        except Exception:
+            # sqlite may already have rolled back, e.g. when the disk is full
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+    def totalSize(self,conn):
+        '''Total size of the stored results, kept in the meta table so it
+doesn't need a scan of all the results.'''
+        row=conn.execute("SELECT value FROM meta WHERE name='totalSize'").fetchone()
+        if row is None:
+            return conn.execute("SELECT COALESCE(SUM(size),0) FROM results").fetchone()[0]
+        return row[0]
@@ -1,5 +1,5 @@
-import sys,copy
-import trees,familiesDTLORstuff
+import sys,os,copy
+import trees,familiesDTLORstuff,mapIndex,resultCache,instrument
 
 # costs
 D = 0.3 # duplication
@@ -8,6 +8,37 @@ L = 0.4 # loss
 O = 0.1 # origin
 R = 0.2 # rearrangment
 
+# DP engine, 'dict' or 'array' (see familiesDTLORstuff.enginesD)
+engine = 'dict'
+
+# number of processes to score the rootings of the gene tree with. More
+# than 1 only helps with that many free CPUs and a gene tree with many
+# rootings, e.g. initFam000001.tre (see familiesDTLORstuff.reconcile)
+numProcesses = 1
+
+# directory for the index of tipMap.tsv and locusMap.tsv (see mapIndex.py),
+# built on the first run
+mapIndexDir = 'mapIndex'
+
+# file for the cache of reconciliation results (see resultCache.py), or
+# None for no cache
+resultCacheFN = None
+
+# directory for checkpoints of families in progress (see checkpoint.py),
+# or None for no checkpoints. A run that is killed can be restarted with
+# the same command, and picks up from its checkpoint. If
+# checkpointTables, the DP tables of the gene tree clades are saved as
+# well, which makes the checkpoints much bigger, but lets a run pick up
+# from within the DP of a rooting. A checkpoint is written at most every
+# checkpointInterval seconds, which bounds the work lost to a crash.
+checkpointDir = None
+checkpointTables = False
+checkpointInterval = 60
+
+# file to append timings of the run to as a line of JSON (see
+# instrument.py), or None to not measure anything
+statsFN = None
+
 ## funcs
 
 def loadD(fn):
@@ -35,25 +66,35 @@ if __name__ == "__main__":
     speciesTreeFN = sys.argv[1]
     geneTreeFN = sys.argv[2]
 
+    if statsFN != None:
+        instrument.enable()
+
     # load stuff
-    speciesTree = trees.readTree(speciesTreeFN)
-    geneTree = trees.loadOneGeneTree(geneTreeFN)
+    with instrument.timed("load trees"):
+        speciesTree = trees.readTree(speciesTreeFN)
+        geneTree = trees.loadOneGeneTree(geneTreeFN)
 
-    bigTipMapD = loadD("tipMap.tsv")
-    tipMapD = {} # cut down to those in this gene tree
-    for leaf in trees.leafList(geneTree):
-        tipMapD[leaf]=bigTipMapD[leaf]
-    
-    locusMapD = loadD("locusMap.tsv")
-    gtLocusMapD = familiesDTLORstuff.reduceLocusMap(geneTree,locusMapD)
+    # only read the map entries for the genes in this gene tree
+    with instrument.timed("load maps"):
+        mapIndexO = mapIndex.loadMapIndex("tipMap.tsv","locusMap.tsv",mapIndexDir)
+        tipMapD = mapIndexO.tipMap(trees.leafList(geneTree))
+        gtLocusMapD = mapIndexO.locusMap(trees.leafList(geneTree))
     locusMapForRootingD = trees.createLocusMapForRootingD(geneTree,copy.deepcopy(gtLocusMapD))
     
     argT = (speciesTree,geneTree,tipMapD,gtLocusMapD,locusMapForRootingD,D,T,L,O,R)
 
-    optRootedGeneTree,optMPR = familiesDTLORstuff.reconcile(argT)
+    resultCacheO = None if resultCacheFN == None else resultCache.ResultCache(resultCacheFN)
+    checkpointFN = None
+    if checkpointDir != None:
+        os.makedirs(checkpointDir,exist_ok=True)
+        checkpointFN = os.path.join(checkpointDir,os.path.basename(geneTreeFN)+".ckpt")
+    optRootedGeneTree,optMPR = familiesDTLORstuff.reconcile(argT,engine,numProcesses=numProcesses,resultCacheO=resultCacheO,checkpointFN=checkpointFN,checkpointTables=checkpointTables,checkpointInterval=checkpointInterval)
 
     print("Rooted tree:")
     print(optRootedGeneTree)
     print()
     print("MPR:")
     print(optMPR)
+
+    if statsFN != None:
+        instrument.recorder.write(statsFN,family=geneTreeFN)
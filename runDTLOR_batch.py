@@ -0,0 +1,179 @@
+import sys,os,glob,argparse,copy,json
+from multiprocessing import Pool
+import trees,familiesDTLORstuff,mapIndex,resultCache,instrument
+from runDTLOR_DP import D,T,L,O,R,engine,mapIndexDir,checkpointTables,checkpointInterval
+
+# Reconciles many gene tree families against one species tree. The
+# species tree is loaded and indexed once, and sent once to each worker
+# process. Each worker opens the memory-mapped index of the tip and
+# locus maps (see mapIndex.py) once, and reads the entries of each
+# family's genes. Each family is written to the output file as soon as
+# it is done, one line per family:
+#
+# family<tab>rooted gene tree (newick, with internal node names)<tab>MPR
+#
+# A family that can't be reconciled has None in place of the tree and
+# MPR if its gene tree is multifurcating, or Error and the error message
+# if it failed, e.g. because a gene is missing from the maps. Remove its
+# line to try it again.
+#
+# The first line of the output file records the costs:
+#
+# #costs<tab>D<tab>T<tab>L<tab>O<tab>R
+#
+# Families already in the output file are skipped, so an interrupted
+# run can be resumed by running the same command again. With
+# --checkpointDir, the families that were in progress pick up from their
+# checkpoints too. With --stats, the timings of each family (see
+# instrument.py) are appended to a file as one line of JSON.
+
+# inputs shared by all families, set in each worker by initWorker
+sharedD = {}
+
+## funcs
+
+def initWorker(speciesTree,indexDir,engine,resultCacheO,checkpointDir,checkpointInterval,instrumented):
+    '''Store the inputs shared by all families in this worker process.'''
+    sharedD['speciesTree'] = speciesTree
+    sharedD['mapIndexO'] = mapIndex.MapIndex(indexDir)
+    sharedD['engine'] = engine
+    sharedD['resultCacheO'] = resultCacheO
+    sharedD['checkpointDir'] = checkpointDir
+    sharedD['checkpointInterval'] = checkpointInterval
+    sharedD['instrumented'] = instrumented
+
+def familyName(geneTreeFN):
+    '''Name of a family in the output file, e.g. initFam000001.'''
+    return os.path.splitext(os.path.basename(geneTreeFN))[0]
+
+def reconcileOneFamily(geneTreeFN):
+    '''Reconcile the gene tree in geneTreeFN using the shared inputs, and
+return its line for the output file, and the instrument report for it
+(or None). If the family fails, e.g. because one of its genes isn't in
+the maps, its line records the error instead, so the other families
+are still written and a rerun doesn't fail on it again.'''
+    if sharedD['instrumented']:
+        instrument.enable()
+    try:
+        line = reconcileOneFamilyLine(geneTreeFN)
+    except Exception as e:
+        line = errorLine(geneTreeFN,e)
+    reportD = None
+    if sharedD['instrumented']:
+        reportD = instrument.disable().report()
+        reportD['family'] = familyName(geneTreeFN)
+    return line,reportD
+
+def errorLine(geneTreeFN,e):
+    '''The line for the output file of a family that failed with
+exception e, with Error in place of the rooted tree and the exception
+in place of the MPR.'''
+    message = " ".join((type(e).__name__+": "+str(e)).split())
+    return familyName(geneTreeFN)+"\tError\t"+message+"\n"
+
+def reconcileOneFamilyLine(geneTreeFN):
+    '''Reconcile the gene tree in geneTreeFN, and return its line for the
+output file.'''
+    with instrument.timed("load trees"):
+        geneTree = trees.loadOneGeneTree(geneTreeFN)
+    if geneTree == None:
+        # multifurcating, can't be reconciled
+        return familyName(geneTreeFN)+"\tNone\tNone\n"
+
+    with instrument.timed("load maps"):
+        tipMapD = sharedD['mapIndexO'].tipMap(trees.leafList(geneTree))
+        gtLocusMapD = sharedD['mapIndexO'].locusMap(trees.leafList(geneTree))
+    locusMapForRootingD = trees.createLocusMapForRootingD(geneTree,copy.deepcopy(gtLocusMapD))
+
+    argT = (sharedD['speciesTree'],geneTree,tipMapD,gtLocusMapD,locusMapForRootingD,D,T,L,O,R)
+    checkpointFN = None
+    if sharedD['checkpointDir'] != None:
+        checkpointFN = os.path.join(sharedD['checkpointDir'],familyName(geneTreeFN)+".ckpt")
+    optRootedGeneTree,optMPR = familiesDTLORstuff.reconcile(argT,sharedD['engine'],verbose=False,resultCacheO=sharedD['resultCacheO'],checkpointFN=checkpointFN,checkpointTables=checkpointTables,checkpointInterval=sharedD['checkpointInterval'])
+
+    # the MPR is keyed by the internal node names, so they are written in
+    # the tree. The rooted tree has no branch lengths.
+    return familyName(geneTreeFN)+"\t"+trees.tupleTree2NoBrLenNewick(optRootedGeneTree)+"\t"+str(optMPR)+"\n"
+
+def costsHeader(costsT):
+    '''The first line of an output file, with the costs (D,T,L,O,R) its
+families were reconciled with.'''
+    return "\t".join(["#costs"]+[repr(cost) for cost in costsT])+"\n"
+
+def loadDoneFamilies(outFN,costsT):
+    '''Return the set of families already in outFN. A last line without
+a newline is from an interrupted run, so it is removed from the file. A
+new file is started with the header for costsT. Raises ValueError if
+outFN holds families reconciled with other costs, since its results
+would then be mixed with ones for costsT.'''
+    doneS = set()
+    header = costsHeader(costsT)
+    if not os.path.exists(outFN):
+        complete = ""
+    else:
+        with open(outFN,"r+") as f:
+            s = f.read()
+            complete = s[:s.rfind("\n")+1]
+            if len(complete) < len(s):
+                f.seek(0)
+                f.truncate(len(complete.encode()))
+    if complete == "":
+        with open(outFN,"w") as f:
+            f.write(header)
+        return doneS
+    linesL = complete.splitlines(keepends=True)
+    if linesL[0] != header:
+        raise ValueError("{} was written with other costs than (D,T,L,O,R) = {} (its first line is {!r}). Use a new output file, or the costs it was written with.".format(outFN,costsT,linesL[0].rstrip("\n")))
+    for line in linesL[1:]:
+        doneS.add(line.split("\t")[0])
+    return doneS
+
+## main
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Reconcile many gene tree families with DTLOR.")
+    parser.add_argument("speciesTreeFN", help="species tree file")
+    parser.add_argument("outFN", help="output file, one line per family")
+    parser.add_argument("geneTreeFN", nargs="+", help="gene tree files or glob patterns, e.g. 'initFam*.tre'")
+    parser.add_argument("--tipMap", default="tipMap.tsv", help="tip map file")
+    parser.add_argument("--locusMap", default="locusMap.tsv", help="locus map file")
+    parser.add_argument("--mapIndex", default=mapIndexDir, help="directory for the index of the tip and locus maps")
+    parser.add_argument("--resultCache", default=None, help="file for a cache of results that persists between runs (see resultCache.py)")
+    parser.add_argument("--resultCacheMB", type=int, default=1024, help="size limit of the result cache in MB")
+    parser.add_argument("--checkpointDir", default=None, help="directory for checkpoints of the families in progress (see checkpoint.py)")
+    parser.add_argument("--checkpointInterval", type=float, default=checkpointInterval, help="seconds between writes of a checkpoint")
+    parser.add_argument("--stats", default=None, help="file to append the timings of each family to, as JSON lines (see instrument.py)")
+    parser.add_argument("--numProcesses", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--engine", default=engine, choices=sorted(familiesDTLORstuff.enginesD), help="DP engine")
+    args = parser.parse_args()
+
+    geneTreeFNL = []
+    for pattern in args.geneTreeFN:
+        # expand patterns ourselves, in case the shell didn't
+        geneTreeFNL.extend(sorted(glob.glob(pattern)) or [pattern])
+
+    try:
+        doneS = loadDoneFamilies(args.outFN,(D,T,L,O,R))
+    except ValueError as e:
+        sys.exit(str(e))
+    todoL = [fn for fn in geneTreeFNL if familyName(fn) not in doneS]
+    print("{} families, {} already done".format(len(geneTreeFNL),len(geneTreeFNL)-len(todoL)),file=sys.stderr)
+
+    # load stuff
+    speciesTree = familiesDTLORstuff.speciesTreeIndex(trees.readTree(args.speciesTreeFN))
+    mapIndex.loadMapIndex(args.tipMap,args.locusMap,args.mapIndex) # build if needed
+
+    resultCacheO = None if args.resultCache == None else resultCache.ResultCache(args.resultCache,args.resultCacheMB<<20)
+    if args.checkpointDir != None:
+        os.makedirs(args.checkpointDir,exist_ok=True)
+
+    initargs = (speciesTree,args.mapIndex,args.engine,resultCacheO,args.checkpointDir,args.checkpointInterval,args.stats != None)
+    with Pool(processes=args.numProcesses,initializer=initWorker,initargs=initargs) as p, \
+         open(args.outFN,"a") as outF:
+        for line,reportD in p.imap_unordered(reconcileOneFamily,todoL):
+            outF.write(line)
+            outF.flush()
+            if reportD != None:
+                with open(args.stats,"a") as statsF:
+                    statsF.write(json.dumps(reportD)+"\n")
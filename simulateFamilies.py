@@ -0,0 +1,309 @@
+import sys,os,math,random,argparse
+import trees
+
+# Simulates gene families on a species tree under the DTLOR model, to
+# make inputs for testing and benchmarking. Each family starts from one
+# or more origins, each a lineage that enters the species tree at a
+# random point with a new syntenic location. Lineages then evolve down
+# the species tree, and on each branch undergo
+#   duplication     the lineage splits in two in the same species. The
+#                   new copy goes to a new location with probability
+#                   dupNewLocusProb, otherwise both stay where they are.
+#   transfer        a copy goes to another species branch alive at the
+#                   same time, keeping its location.
+#   loss            the lineage ends.
+#   rearrangement   the lineage moves to a new location.
+# as a Poisson process, each at its rate per unit of branch length.
+# Branches without a length have length 1. At a species node every
+# lineage is copied to both children, and the lineages that reach the
+# tips are the genes of the family.
+#
+# New locations are drawn from a pool of numLoci locations per family,
+# or are always new if numLoci is None. Gene numbers and locations are
+# unique across all the families written to a directory, as they are in
+# the maps from xenoGI.
+#
+# Writes, in outDir, the species tree (speciesTree.tre), one gene tree
+# per family (<stem>000001.tre etc.) and the tip map and locus map
+# (tipMap.tsv, locusMap.tsv) for all the families. These can be read
+# with trees.readTree, trees.loadOneGeneTree and runDTLOR_DP.loadD.
+
+## funcs
+
+def randomSpeciesTree(numSpecies,rng):
+    '''Random species tree with tips s0, s1, ... and internal nodes
+i0 (the root), i1, ..., made by joining random pairs of subtrees.'''
+    subtreesL=[("s"+str(i),(),(),None) for i in range(numSpecies)]
+    for i in range(numSpecies-2,-1,-1):
+        left=subtreesL.pop(rng.randrange(len(subtreesL)))
+        right=subtreesL.pop(rng.randrange(len(subtreesL)))
+        subtreesL.append(("i"+str(i),left,right,None))
+    return subtreesL[0]
+
+def speciesBranches(speciesTree):
+    '''Return a dict mapping each node of speciesTree to (start time, end
+time, child nodes) for the branch above it, with time 0 at the top of
+the root branch.'''
+    branchesD={}
+    # the branches are added in preorder, each with the subtree below
+    # it and its start time
+    stack=[(speciesTree,0)]
+    while stack:
+        tree,start=stack.pop()
+        length=1 if tree[3] is None else tree[3]
+        childrenT=trees.childSubtrees(tree)
+        branchesD[tree[0]]=(start,start+length,tuple(child[0] for child in childrenT))
+        for child in reversed(childrenT):
+            stack.append((child,start+length))
+    return branchesD
+
+def poisson(mean,rng):
+    '''Random number from a Poisson distribution with mean.'''
+    limit=math.exp(-mean)
+    k=0
+    p=rng.random()
+    while p>limit:
+        k+=1
+        p*=rng.random()
+    return k
+
+class TooManyGenes(Exception):
+    '''Raised when a simulation makes more than its limit of genes.'''
+    pass
+
+class FamilySimulator:
+    '''Simulates the gene families of one species tree. Genes are
+numbered from firstGene and locations from firstLocus, continuing from
+family to family.'''
+
+    def __init__(self,speciesTree,rng,dupRate=0.3,transferRate=0.2,lossRate=0.2,rearrangeRate=0.2,
+                 meanOrigins=1.5,dupNewLocusProb=0.5,numLoci=None,firstGene=0,firstLocus=0):
+        self.speciesTree=speciesTree
+        self.branchesD=speciesBranches(speciesTree)
+        self.rng=rng
+        self.dupRate=dupRate
+        self.transferRate=transferRate
+        self.lossRate=lossRate
+        self.rearrangeRate=rearrangeRate
+        self.meanOrigins=meanOrigins
+        self.dupNewLocusProb=dupNewLocusProb
+        self.numLoci=numLoci
+        self.nextGene=firstGene
+        self.nextLocus=firstLocus
+
+    def newLocus(self,lociL):
+        '''Draw a location for a family whose locations so far are lociL.'''
+        if self.numLoci is None or len(lociL)<self.numLoci:
+            lociL.append(self.nextLocus)
+            self.nextLocus+=1
+            return lociL[-1]
+        return self.rng.choice(lociL)
+
+    def lineage(self,node,time,locus,familyD):
+        '''Simulate a lineage on the species branch above node, starting at
+time at locus. Returns the gene tree below it, with the absolute time
+of each gene tree node in place of its branch length, or None if all of
+it was lost.'''
+        # The stack holds the lineages still to simulate, as (node,time,
+        # locus), and the joins still to make, as (time,). A lineage that
+        # splits pushes its join and then its two parts, the first part on
+        # top, so the parts are simulated (and their random numbers drawn)
+        # in the same order as by depth first search. The gene trees wait
+        # on treesL until they are joined.
+        treesL=[]
+        stack=[(node,time,locus)]
+        while stack:
+            item=stack.pop()
+            if len(item)==1:
+                right=treesL.pop()
+                left=treesL.pop()
+                treesL.append(self.join(left,right,item[0]))
+                continue
+            tree,splitT=self.branch(*item,familyD)
+            if splitT is None:
+                treesL.append(tree)
+            else:
+                splitTime,firstT,secondT=splitT
+                stack.append((splitTime,))
+                stack.append(secondT)
+                stack.append(firstT)
+        return treesL[0]
+
+    def branch(self,node,time,locus,familyD):
+        '''Simulate a lineage on the species branch above node, starting at
+time at locus, until it ends or splits in two. Returns (tree,splitT). If
+it split, by a duplication, a transfer or at the species node below the
+branch, splitT is (time of the split,firstT,secondT), where firstT and
+secondT are (node,time,locus) of the two lineages it split into. If it
+ended, splitT is None and tree is its gene tree: a gene if it reached a
+species tip, or None if it was lost.'''
+        start,end,childrenT=self.branchesD[node]
+        totalRate=self.dupRate+self.transferRate+self.lossRate+self.rearrangeRate
+        while True:
+            if totalRate>0:
+                time+=self.rng.expovariate(totalRate)
+            if totalRate==0 or time>=end:
+                break
+            x=self.rng.random()*totalRate
+            if x<self.dupRate:
+                newLocus=locus
+                if self.rng.random()<self.dupNewLocusProb:
+                    newLocus=self.newLocus(familyD['lociL'])
+                return None,(time,(node,time,locus),(node,time,newLocus))
+            x-=self.dupRate
+            if x<self.transferRate:
+                recipientsL=[other for other,(otherStart,otherEnd,_) in self.branchesD.items() \
+                             if otherStart<=time<otherEnd and other!=node]
+                if recipientsL!=[]:
+                    recipient=self.rng.choice(recipientsL)
+                    return None,(time,(node,time,locus),(recipient,time,locus))
+                continue
+            x-=self.transferRate
+            if x<self.lossRate:
+                return None,None
+            locus=self.newLocus(familyD['lociL'])
+
+        if childrenT==():
+            # reached a species tip
+            gene=self.nextGene
+            self.nextGene+=1
+            familyD['tipMapD'][gene]=node
+            familyD['locusMapD'][gene]=locus
+            if len(familyD['tipMapD'])>familyD['maxGenes']:
+                raise TooManyGenes
+            return (gene,(),(),end),None
+        return None,(end,(childrenT[0],end,locus),(childrenT[1],end,locus))
+
+    def join(self,left,right,time):
+        '''Join two gene trees at a node at time. Lost lineages are None and
+are left out, so there are no nodes with one child.'''
+        if left is None:
+            return right
+        if right is None:
+            return left
+        return (None,left,right,time)
+
+    def family(self,maxGenes=float('inf')):
+        '''Simulate one family. Returns (geneTree,tipMapD,locusMapD), where
+geneTree has the absolute time of each node in place of its branch
+length, or None if every gene was lost. Raises TooManyGenes if the
+family gets more than maxGenes genes.'''
+        familyD={'tipMapD':{},'locusMapD':{},'lociL':[],'maxGenes':maxGenes}
+        # origins, each at a random point of the species tree
+        nodesL=list(self.branchesD)
+        weightsL=[end-start for start,end,_ in self.branchesD.values()]
+        geneTree=None
+        for i in range(1+poisson(max(0,self.meanOrigins-1),self.rng)):
+            node=self.rng.choices(nodesL,weightsL)[0]
+            start,end,_=self.branchesD[node]
+            time=self.rng.uniform(start,end)
+            originTree=self.lineage(node,time,self.newLocus(familyD['lociL']),familyD)
+            # origins are joined above the species tree, the gene tree is
+            # unrooted anyway
+            geneTree=self.join(geneTree,originTree,-1)
+        return geneTree,familyD['tipMapD'],familyD['locusMapD']
+
+    def familyOfSize(self,minGenes,maxGenes,maxTries=1000):
+        '''Simulate a family with between minGenes and maxGenes genes. A
+family with too many genes has random genes removed, one with too few
+is simulated again. Gene numbers and locations of rejected families
+are skipped.'''
+        minGenes=max(minGenes,2)
+        for i in range(maxTries):
+            try:
+                geneTree,tipMapD,locusMapD=self.family(20*maxGenes)
+            except TooManyGenes:
+                continue
+            if len(tipMapD)<minGenes:
+                continue
+            if len(tipMapD)>maxGenes:
+                keepS=set(self.rng.sample(sorted(tipMapD),maxGenes))
+                geneTree=pruneGeneTree(geneTree,keepS)
+                tipMapD={gene:tipMapD[gene] for gene in keepS}
+                locusMapD={gene:locusMapD[gene] for gene in keepS}
+            return geneTree,tipMapD,locusMapD
+        raise ValueError("No family with {} to {} genes in {} tries. Try other rates.".format(minGenes,maxGenes,maxTries))
+
+def pruneGeneTree(geneTree,keepS):
+    '''Return geneTree with only the genes in keepS, or None if there are
+none. Nodes left with one child are removed.'''
+    # as in trees.prune, but keeping the node times
+    prunedL=[]
+    for tree in trees.iterPostorder(geneTree):
+        if tree[1]==():
+            prunedL.append(tree if tree[0] in keepS else None)
+            continue
+        right=prunedL.pop()
+        left=prunedL.pop()
+        if left is None:
+            prunedL.append(right)
+        elif right is None:
+            prunedL.append(left)
+        else:
+            prunedL.append((tree[0],left,right,tree[3]))
+    return prunedL[0]
+
+def geneTreeNewick(geneTree):
+    '''Newick string of a simulated gene tree, with branch lengths from
+the node times and no internal node names.'''
+    # The strings of subtrees, without the length of the branch above
+    # them, wait on stringsL with their times until their parent is
+    # written, which gives the branch lengths.
+    stringsL=[]
+    for tree in trees.iterPostorder(geneTree):
+        if tree[1]==():
+            stringsL.append((str(tree[0]),tree[3]))
+            continue
+        right,rightTime=stringsL.pop()
+        left,leftTime=stringsL.pop()
+        stringsL.append(("({}:{:.5f},{}:{:.5f})".format(left,max(leftTime-tree[3],0),right,max(rightTime-tree[3],0)),tree[3]))
+    return stringsL[0][0]+";"
+
+def writeFamilies(speciesTree,outDir,numFamilies,seed=0,minGenes=4,maxGenes=100,stem="simFam",**ratesD):
+    '''Simulate numFamilies families on speciesTree, with minGenes to
+maxGenes genes each, and write them to outDir. ratesD are passed to
+FamilySimulator. Returns the list of gene tree files.'''
+    os.makedirs(outDir,exist_ok=True)
+    trees.writeTreeNoBrLen(speciesTree,os.path.join(outDir,"speciesTree.tre"))
+    simulator=FamilySimulator(speciesTree,random.Random(seed),**ratesD)
+    geneTreeFNL=[]
+    with open(os.path.join(outDir,"tipMap.tsv"),"w") as tipF, \
+         open(os.path.join(outDir,"locusMap.tsv"),"w") as locusF:
+        for famNum in range(1,numFamilies+1):
+            geneTree,tipMapD,locusMapD=simulator.familyOfSize(minGenes,maxGenes)
+            geneTreeFN=os.path.join(outDir,"{}{:06d}.tre".format(stem,famNum))
+            with open(geneTreeFN,"w") as f:
+                f.write(geneTreeNewick(geneTree)+"\n")
+            for gene in sorted(tipMapD):
+                tipF.write("{}\t{}\n".format(gene,tipMapD[gene]))
+                locusF.write("{}\t{}\n".format(gene,locusMapD[gene]))
+            geneTreeFNL.append(geneTreeFN)
+    return geneTreeFNL
+
+## main
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Simulate gene families on a species tree under the DTLOR model.")
+    parser.add_argument("speciesTreeFN", help="species tree file, as for trees.readTree")
+    parser.add_argument("outDir", help="directory to write the families, tip map and locus map to")
+    parser.add_argument("--numFamilies", type=int, default=100, help="number of families")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--minGenes", type=int, default=4, help="fewest genes in a family")
+    parser.add_argument("--maxGenes", type=int, default=100, help="most genes in a family")
+    parser.add_argument("--stem", default="simFam", help="start of the gene tree file names")
+    parser.add_argument("--dupRate", type=float, default=0.3, help="duplications per lineage per unit branch length")
+    parser.add_argument("--transferRate", type=float, default=0.2, help="transfers per lineage per unit branch length")
+    parser.add_argument("--lossRate", type=float, default=0.2, help="losses per lineage per unit branch length")
+    parser.add_argument("--rearrangeRate", type=float, default=0.2, help="rearrangements per lineage per unit branch length")
+    parser.add_argument("--meanOrigins", type=float, default=1.5, help="mean number of origins per family (at least 1)")
+    parser.add_argument("--dupNewLocusProb", type=float, default=0.5, help="probability a duplicate goes to a new location")
+    parser.add_argument("--numLoci", type=int, default=None, help="number of locations a family draws from (default: always new)")
+    args = parser.parse_args()
+
+    speciesTree = trees.readTree(args.speciesTreeFN)
+    geneTreeFNL = writeFamilies(speciesTree,args.outDir,args.numFamilies,args.seed,args.minGenes,args.maxGenes,args.stem,
+                                dupRate=args.dupRate,transferRate=args.transferRate,lossRate=args.lossRate,
+                                rearrangeRate=args.rearrangeRate,meanOrigins=args.meanOrigins,
+                                dupNewLocusProb=args.dupNewLocusProb,numLoci=args.numLoci)
+    print("Wrote {} families to {}".format(len(geneTreeFNL),args.outDir),file=sys.stderr)
@@ -0,0 +1,231 @@
+import os,sys,copy,pickle,random,itertools,subprocess
+from multiprocessing import Pool
+import pytest
+import trees,familiesDTLORstuff,DTLOR_DP,DTLOR_DP_array,Greedy,mapIndex,resultCache,checkpoint,checkEngines,runDTLOR_batch
+from runDTLOR_DP import loadD
+
+# Tests of the DP engines, Greedy, the MPR graph and the pieces that
+# support runs of many families (the map index, the result cache,
+# checkpoints and resuming runDTLOR_batch.py). Run with
+#
+# python3 -m pytest -q
+#
+# checkEngines.py compares the engines on many more (simulated)
+# families.
+
+repoDir = os.path.dirname(os.path.abspath(__file__))
+
+## helpers
+
+@pytest.fixture(scope="module")
+def mapIndexO(tmp_path_factory):
+    '''MapIndex of the bundled tip and locus maps, built in a temporary
+directory.'''
+    return mapIndex.loadMapIndex(os.path.join(repoDir,"tipMap.tsv"),os.path.join(repoDir,"locusMap.tsv"),str(tmp_path_factory.mktemp("mapIndex")))
+
+def bundledFamily(mapIndexO,family):
+    '''Return (speciesTreeD,rootingsL,tipMapD,gtLocusMapD) for one of the
+bundled families, with the species tree in the format of the DP.'''
+    speciesTree=trees.readTree(os.path.join(repoDir,"speciesTree.tre"))
+    geneTree=trees.loadOneGeneTree(os.path.join(repoDir,family+".tre"))
+    tipMapD=mapIndexO.tipMap(trees.leafList(geneTree))
+    gtLocusMapD=mapIndexO.locusMap(trees.leafList(geneTree))
+    locusMapForRootingD=trees.createLocusMapForRootingD(geneTree,copy.deepcopy(gtLocusMapD))
+    rootingsL=trees.get_all_rerootings(geneTree,locusMapForRootingD) or [geneTree]
+    return trees.parseTreeForDP(speciesTree,parasite=False),rootingsL,tipMapD,gtLocusMapD
+
+def greedyGraph(mprGraph,cost):
+    '''The MPR graph in the format of Greedy.py: each mapping node has a
+list of [type, child, child, support] for its events, with
+(None,None,None,None) for a missing child, and the cost last.'''
+    nullChild=(None,None,None,None)
+    supportD=mprGraph.event_support()
+    DTLOR={}
+    for mapping,eventsL in mprGraph.graph.items():
+        DTLOR[mapping]=[[event[0],nullChild if event[1] is None else event[1],nullChild if event[2] is None else event[2], \
+                         supportD[(mapping,event)]] for event in eventsL]+[cost]
+    return DTLOR
+
+def repeatedGreedyOnce(DTLOR,ParasiteTree):
+    '''Greedy as it was before it was made incremental: greedyOnce is
+called until the scores of all the events have been collected.'''
+    scoresL=[]
+    recL=[]
+    currentDTLOR=copy.deepcopy(DTLOR)
+    while True:
+        oneTree,currentDTLOR,score=Greedy.greedyOnce(currentDTLOR,ParasiteTree)
+        scoresL.append(score)
+        recL.append(oneTree)
+        if all(currentDTLOR[key][i][-1]==0 for key in currentDTLOR for i in range(len(currentDTLOR[key])-1)):
+            return scoresL,recL
+
+def allMPRs(mprGraph):
+    '''Every MPR of mprGraph, as a frozenset of (mapping node, event), by
+brute force.'''
+    def below(mapping):
+        for event in mprGraph.graph[mapping]:
+            childrenL=[child for child in event[1:] if child is not None]
+            for partsT in itertools.product(*[below(child) for child in childrenL]):
+                yield frozenset([(mapping,event)]).union(*partsT)
+    return [MPR for root in mprGraph.roots for MPR in below(root)]
+
+def putOne(argT):
+    '''Store one result in a ResultCache, from a worker process.'''
+    resultCacheO,key=argT
+    resultCacheO.put(key,(key,"x"*100))
+
+## tests
+
+def testEnginesAgree(mapIndexO):
+    for family in ['initFam000220','initFam000060']:
+        speciesTreeD,rootingsL,tipMapD,gtLocusMapD=bundledFamily(mapIndexO,family)
+        for rooting in rootingsL:
+            geneTreeD=trees.parseTreeForDP(rooting,parasite=True)
+            assert checkEngines.checkRooting(speciesTreeD,geneTreeD,tipMapD,gtLocusMapD)==[]
+
+def testReconcileEnginesAgree(mapIndexO):
+    speciesTree=trees.readTree(os.path.join(repoDir,"speciesTree.tre"))
+    geneTree=trees.loadOneGeneTree(os.path.join(repoDir,"initFam000060.tre"))
+    tipMapD=mapIndexO.tipMap(trees.leafList(geneTree))
+    gtLocusMapD=mapIndexO.locusMap(trees.leafList(geneTree))
+    argT=(speciesTree,geneTree,tipMapD,gtLocusMapD)
+    costsL=[(1,1,1,1,1),(2,3,1,1,1)]
+    sweepL=familiesDTLORstuff.reconcileSweep(argT+(trees.createLocusMapForRootingD(geneTree,copy.deepcopy(gtLocusMapD)),),costsL)
+    for costT,(sweepCost,_,_) in zip(costsL,sweepL):
+        scoresL=[]
+        for engine in ['dict','array']:
+            locusMapForRootingD=trees.createLocusMapForRootingD(geneTree,copy.deepcopy(gtLocusMapD))
+            speciesTreeI,rootingsL,geneSymbols,locusSymbols,tipMapI,gtLocusMapI = \
+                familiesDTLORstuff.prepareFamily(speciesTree,geneTree,tipMapD,gtLocusMapD,locusMapForRootingD)
+            bestScore,_,_=familiesDTLORstuff.scoreRootings(rootingsL,speciesTreeI,geneSymbols,tipMapI,gtLocusMapI,*costT,engine,{},False)
+            scoresL.append(bestScore)
+        assert scoresL[0]==pytest.approx(scoresL[1])
+        assert scoresL[0]==pytest.approx(sweepCost)
+
+def testGreedyMatchesRepeatedGreedyOnce(mapIndexO):
+    for family in ['initFam000220','initFam000060']:
+        speciesTreeD,rootingsL,tipMapD,gtLocusMapD=bundledFamily(mapIndexO,family)
+        for rooting in rootingsL[:3]:
+            geneTreeD=trees.parseTreeForDP(rooting,parasite=True)
+            mprGraph,cost=DTLOR_DP.DP(speciesTreeD,geneTreeD,tipMapD,gtLocusMapD,1,1,1,1,1,graph=True)
+            DTLOR=greedyGraph(mprGraph,cost)
+            ParasiteTree={'pTop':(None,rooting[0])}
+            scoresL,recL=Greedy.Greedy(DTLOR,ParasiteTree)
+            oldScoresL,oldRecL=repeatedGreedyOnce(DTLOR,ParasiteTree)
+            assert scoresL==pytest.approx(oldScoresL)
+            assert len(recL)==len(oldRecL)
+            # the score of a reconciliation is the support of its events
+            supportD={(mapping,tuple(event[:3])):event[3] for mapping in DTLOR for event in DTLOR[mapping][:-1]}
+            assert scoresL[0]==pytest.approx(sum(supportD[(mapping,tuple(event))] for mapping,event in recL[0].items()))
+
+def testMPRCountsSupportAndSampling(mapIndexO):
+    # with free losses, this rooting has 21 MPRs
+    speciesTreeD,rootingsL,tipMapD,gtLocusMapD=bundledFamily(mapIndexO,'initFam000220')
+    geneTreeD=trees.parseTreeForDP(rootingsL[0],parasite=True)
+    for engine in [DTLOR_DP,DTLOR_DP_array]:
+        mprGraph,cost=engine.DP(speciesTreeD,geneTreeD,tipMapD,gtLocusMapD,1,1,0,1,1,graph=True)
+        MPRsL=allMPRs(mprGraph)
+        assert mprGraph.count()==len(MPRsL)==len(set(MPRsL))>1
+        supportD=mprGraph.event_support()
+        for mapping,eventsL in mprGraph.graph.items():
+            for event in eventsL:
+                fraction=sum(1 for MPR in MPRsL if (mapping,event) in MPR)/len(MPRsL)
+                assert supportD[(mapping,event)]==pytest.approx(fraction)
+
+        # each MPR is sampled about equally often
+        samplesL=mprGraph.sample(200*len(MPRsL),seed=1)
+        assert samplesL==mprGraph.sample(200*len(MPRsL),seed=1)
+        sampleCountsD={}
+        for sample in samplesL:
+            MPR=frozenset(sample.items())
+            sampleCountsD[MPR]=sampleCountsD.get(MPR,0)+1
+        assert set(sampleCountsD)==set(MPRsL)
+        assert all(100<count<300 for count in sampleCountsD.values())
+
+        with pytest.raises(ValueError):
+            mprGraph.sample(event_weight=lambda event: 0)
+
+def testMapIndex(mapIndexO,tmp_path):
+    tipMapD=loadD(os.path.join(repoDir,"tipMap.tsv"))
+    locusMapD=loadD(os.path.join(repoDir,"locusMap.tsv"))
+    genesL=random.Random(0).sample(sorted(tipMapD),500)
+    assert mapIndexO.tipMap(genesL)=={gene:tipMapD[gene] for gene in genesL}
+    assert mapIndexO.locusMap(genesL)=={gene:locusMapD[gene] for gene in genesL}
+    for gene in [max(tipMapD)+1,-1,"g1"]:
+        with pytest.raises(KeyError):
+            mapIndexO.tipMap([gene])
+
+    # the index is rebuilt when a map changes
+    tipFN,locusFN,indexDir=str(tmp_path/"tip.tsv"),str(tmp_path/"locus.tsv"),str(tmp_path/"index")
+    for fn,value in [(tipFN,"s1"),(locusFN,"7")]:
+        with open(fn,"w") as f:
+            f.write("1\t"+value+"\n")
+    assert mapIndex.loadMapIndex(tipFN,locusFN,indexDir).locusMap([1])=={1:7}
+    with open(locusFN,"w") as f:
+        f.write("1\t8\n2\tl2\n")
+    assert mapIndex.loadMapIndex(tipFN,locusFN,indexDir).locusMap([1,2])=={1:8,2:"l2"}
+
+def testResultCacheEvictsLeastRecentlyUsed(tmp_path):
+    valueSize=len(pickle.dumps(("a","x"*100),protocol=pickle.HIGHEST_PROTOCOL))
+    resultCacheO=resultCache.ResultCache(str(tmp_path/"results.db"),int(2.5*valueSize))
+    resultCacheO.put("a",("a","x"*100))
+    resultCacheO.put("b",("b","x"*100))
+    assert resultCacheO.get("a")==("a","x"*100)
+    resultCacheO.put("c",("c","x"*100))
+    assert resultCacheO.get("b") is None
+    assert resultCacheO.get("a")==("a","x"*100)
+    assert resultCacheO.get("c")==("c","x"*100)
+
+def testResultCacheConcurrentPut(tmp_path):
+    resultCacheO=resultCache.ResultCache(str(tmp_path/"results.db"))
+    keysL=[str(i) for i in range(40)]
+    with Pool(processes=4) as p:
+        p.map(putOne,[(resultCacheO,key) for key in keysL])
+    for key in keysL:
+        assert resultCacheO.get(key)==(key,"x"*100)
+    conn=resultCacheO.connection()
+    assert resultCacheO.totalSize(conn)==conn.execute("SELECT SUM(size) FROM results").fetchone()[0]
+
+def testCheckpointTruncatedRecord(tmp_path):
+    checkpointFN=str(tmp_path/"family.ckpt")
+    checkpointO=checkpoint.Checkpoint(checkpointFN,"key","dict",interval=0)
+    assert checkpointO.load()==[]
+    checkpointO.add((0,2),(3.0,1,1))
+    checkpointO.add((2,4),(2.0,2,3))
+    size=os.path.getsize(checkpointFN)
+    checkpointO.add((4,6),(1.0,1,5))
+    # the run is killed while writing the last record
+    with open(checkpointFN,"r+b") as f:
+        f.truncate(os.path.getsize(checkpointFN)-3)
+
+    assert checkpoint.Checkpoint(checkpointFN,"key","dict").load()==[(0,2,(3.0,1,1)),(2,4,(2.0,2,3))]
+    assert os.path.getsize(checkpointFN)==size
+    # a checkpoint for other inputs is started again
+    assert checkpoint.Checkpoint(checkpointFN,"other key","dict").load()==[]
+
+def testBatchResume(tmp_path):
+    outFN=str(tmp_path/"out.tsv")
+    familiesL=['initFam000220','initFam001601']
+    commandL=[sys.executable,os.path.join(repoDir,"runDTLOR_batch.py"),os.path.join(repoDir,"speciesTree.tre"),outFN]+ \
+        [os.path.join(repoDir,family+".tre") for family in familiesL]+ \
+        ["--tipMap",os.path.join(repoDir,"tipMap.tsv"),"--locusMap",os.path.join(repoDir,"locusMap.tsv"),
+         "--mapIndex",str(tmp_path/"mapIndex"),"--numProcesses","1"]
+    subprocess.run(commandL,check=True,capture_output=True)
+    with open(outFN) as f:
+        linesL=f.readlines()
+    assert linesL[0]==runDTLOR_batch.costsHeader((runDTLOR_batch.D,runDTLOR_batch.T,runDTLOR_batch.L,runDTLOR_batch.O,runDTLOR_batch.R))
+    assert sorted(line.split("\t")[0] for line in linesL[1:])==familiesL
+
+    # the run is killed while writing the second family
+    with open(outFN,"w") as f:
+        f.write("".join(linesL[:2])+linesL[2][:10])
+    done=subprocess.run(commandL,check=True,capture_output=True,text=True)
+    assert "2 families, 1 already done" in done.stderr
+    with open(outFN) as f:
+        resumedL=f.readlines()
+    assert resumedL[:2]==linesL[:2]
+    assert sorted(line.split("\t")[0] for line in resumedL[1:])==familiesL
+
+    # a file written with other costs is refused
+    with pytest.raises(ValueError):
+        runDTLOR_batch.loadDoneFamilies(outFN,(9,9,9,9,9))
@@ -13,63 +13,105 @@ def bioPhyloToTupleTree(bpTree):
 
 def bioPhyloCladeToTupleTree(clade):
     '''Convert a biopython clade object to 4 tuple tree.'''
-    nm = clade.name
-    br = clade.branch_length
-    if clade.is_terminal():
-        return (nm,(),(),br)
-    else:
-        lt = bioPhyloCladeToTupleTree(clade[0])
-        rt = bioPhyloCladeToTupleTree(clade[1])
-        return (nm,lt,rt,br)
+    # the converted subtrees are kept on subtreesL until their parent
+    # is converted
+    subtreesL=[]
+    for clade in iterPostorder(clade,lambda clade: clade.clades):
+        nm = clade.name
+        br = clade.branch_length
+        if clade.is_terminal():
+            subtreesL.append((nm,(),(),br))
+        else:
+            rt = subtreesL.pop()
+            lt = subtreesL.pop()
+            subtreesL.append((nm,lt,rt,br))
+    return subtreesL[0]
     
+# The subtrees of the most recently traversed trees (see
+# preorderSubtrees), keyed by id. Tuple trees can't be weakly referenced,
+# so each entry holds on to its tree, which keeps the id from being reused.
+subtreeCacheSize = 32
+subtreeCacheD = OrderedDict()
+
+def childSubtrees(tree):
+    '''The left and right subtrees of tree, or () if it is a leaf.'''
+    if tree[1]==():
+        return ()
+    return (tree[1],tree[2])
+
+def iterSubtrees(tree):
+    '''Generate the subtrees of tree in preorder (a node, then the subtrees
+of its left child, then those of its right child).'''
+    stack=[tree]
+    while stack:
+        subtree=stack.pop()
+        yield subtree
+        if subtree[1]!=():
+            stack.append(subtree[2])
+            stack.append(subtree[1])
+
+def iterPostorder(tree,childFunc=childSubtrees):
+    '''Generate the nodes of tree in postorder (the nodes below each child
+from left to right, then the node itself). childFunc gives the children
+of a node, by default those of a tuple tree, so the nodes of other trees
+(e.g. biopython clades) can be generated too. A node for which childFunc
+returns () is treated as a leaf.'''
+    # Each entry is (node, expanded), where expanded means its children
+    # have already been pushed
+    stack=[(tree,False)]
+    while stack:
+        node,expanded=stack.pop()
+        if expanded:
+            yield node
+            continue
+        childL=childFunc(node)
+        if len(childL)==0:
+            yield node
+        else:
+            stack.append((node,True))
+            for child in reversed(childL):
+                stack.append((child,False))
+
+def preorderSubtrees(tree):
+    '''Return a tuple of the subtrees of tree in preorder. The result is
+cached for the most recently used trees, so the traversals below cost one
+pass over a tree however many of them are done on it.'''
+    entry=subtreeCacheD.get(id(tree))
+    if entry!=None and entry[0] is tree:
+        subtreeCacheD.move_to_end(id(tree))
+        return entry[1]
+    subtreesT=tuple(iterSubtrees(tree))
+    subtreeCacheD[id(tree)]=(tree,subtreesT)
+    if len(subtreeCacheD)>subtreeCacheSize:
+        subtreeCacheD.popitem(last=False)
+    return subtreesT
+
 def nodeCount(tree):
     '''How many nodes in tree?'''
-    if tree[1]==():
-        return 1
-    else:
-        return 1+ nodeCount(tree[1]) + nodeCount(tree[2])
+    return len(preorderSubtrees(tree))
 
 def nodeList(tree):
     '''Return list of nodes in tree.'''
-    if tree[1]==():
-        return [tree[0]]
-    else:
-        return [tree[0]] + nodeList(tree[1]) + nodeList(tree[2])
+    return [subtree[0] for subtree in preorderSubtrees(tree)]
     
 def leafCount(tree):
     '''How many leaves in tree?'''
-    if tree[1]==():
-        return 1
-    else:
-        return leafCount(tree[1]) + leafCount(tree[2])
+    return sum(1 for subtree in preorderSubtrees(tree) if subtree[1]==())
 
 def leafList(tree):
     '''Return list of leaves in tree.'''
-    if tree[1]==():
-        return [tree[0]]
-    else:
-        return leafList(tree[1]) + leafList(tree[2])
+    return [subtree[0] for subtree in preorderSubtrees(tree) if subtree[1]==()]
 
 def iNodeList(tree):
     '''Return list of internal nodes in tree.'''
-    if tree[1]==():
-        return []
-    else:
-        return [tree[0]] + iNodeList(tree[1]) + iNodeList(tree[2])
+    return [subtree[0] for subtree in preorderSubtrees(tree) if subtree[1]!=()]
     
 def subtree(tree,node):
     '''Return the subtree with node at its root. Assume node is in tree.'''
-    if tree[0]==node:
-        return tree
-    elif tree[1]==():
-        return None
-    else:
-        l=subtree(tree[1],node)
-        r=subtree(tree[2],node)
-        if l==None:
-            return r
-        else:
-            return l
+    for subtree in iterSubtrees(tree):
+        if subtree[0]==node:
+            return subtree
+    return None
     
 def prune(tree,strainsToKeep):
     '''Given a tree and a group of strains strainsToKeep (which we assume
@@ -77,21 +119,26 @@ are a subset of the strains in tree), prune to yield the tree with
 only those strains. We will assume tree has no branch lengths, and
 will thus always put None in the 4 position of the pruned tree.
     '''
-    if tree[1]==():
-        if tree[0] in strainsToKeep:
-            return (tree[0],(),(),None)
+    # the pruned subtrees (None if no strain is kept) are kept on
+    # prunedL until their parent is pruned
+    prunedL=[]
+    for subtree in iterPostorder(tree):
+        if subtree[1]==():
+            if subtree[0] in strainsToKeep:
+                prunedL.append((subtree[0],(),(),None))
+            else:
+                prunedL.append(None)
         else:
-            return None
-    else:
-        l = prune(tree[1],strainsToKeep)
-        r = prune(tree[2],strainsToKeep)
+            r = prunedL.pop()
+            l = prunedL.pop()
 
-        if l != None and r != None:
-            return (tree[0],l,r,None)
-        elif l == None:
-            return r
-        else:
-            return l
+            if l != None and r != None:
+                prunedL.append((subtree[0],l,r,None))
+            elif l == None:
+                prunedL.append(r)
+            else:
+                prunedL.append(l)
+    return prunedL[0]
         
 def isRootNode(tree,mrcaNum):
     '''Is mrcaNum the root node?'''
@@ -128,10 +175,7 @@ def readTree(filename):
 
 def createSubtreeL(tree):
     '''Return a list containing all subtrees.'''
-    if tree[1]==():
-        return [tree]
-    else:
-        return [tree]+createSubtreeL(tree[1]) + createSubtreeL(tree[2])
+    return list(preorderSubtrees(tree))
 
 def createSubtreeD(tree):
     '''Get all subtrees and put them in a dict keyed by root node name.'''
@@ -151,18 +195,11 @@ leaves which are most closely related to leaf.'''
     
 def getParent(leaf,tree):
     '''Return parent node of leaf.'''
-    if tree[1] == ():
-        # We've come too far, it wasn't there
-        return None
-    elif tree[1][0] == leaf or tree[2][0] == leaf:
-        return tree[0]
-    else:
-        left = getParent(leaf,tree[1])
-        right = getParent(leaf,tree[2])
-
-        if left != None:
-            return left
-        else: return right
+    for subtree in iterSubtrees(tree):
+        if subtree[1] != () and (subtree[1][0] == leaf or subtree[2][0] == leaf):
+            return subtree[0]
+    # it wasn't there
+    return None
 
 def getRootFocalCladeFromOutgroup(tree,outGroup):
     '''Given a rooted tree and an outgroup, find the
@@ -179,23 +216,30 @@ def getRootFocalCladeFromOutgroup(tree,outGroup):
     
 def isSpeciesPresent(tree,species):
     '''Return True is species in tree, False otherwise.'''
-    if tree[1]==():
-        if tree[0]==species: return True
-        else: return False
-    else:
-        l=isSpeciesPresent(tree[1],species)
-        r=isSpeciesPresent(tree[2],species)
-        return l or r
+    for subtree in iterSubtrees(tree):
+        if subtree[1]==() and subtree[0]==species:
+            return True
+    return False
         
 def tupleTree2Newick(tree):
     '''Convert a four tuple based tree (root,left,right,branchLen) into a
 newick formated string.'''
-    if tree[1]==():
-        return str(tree[0])+":"+str(tree[3])
-    else:
-        leftStr=tupleTree2Newick(tree[1])
-        rightStr=tupleTree2Newick(tree[2])
-        return "("+leftStr+","+rightStr+"):"+str(tree[3])
+    return newickString(tree,lambda subtree: ":"+str(subtree[3]))
+
+def newickString(tree,labelFunc):
+    '''Newick string for tree, where labelFunc gives the text written
+after a subtree (for a leaf, after its name).'''
+    # the strings of subtrees are kept on stringsL until their parent is
+    # written
+    stringsL=[]
+    for subtree in iterPostorder(tree):
+        if subtree[1]==():
+            stringsL.append(str(subtree[0])+labelFunc(subtree))
+        else:
+            rightString=stringsL.pop()
+            leftString=stringsL.pop()
+            stringsL.append("("+leftString+","+rightString+")"+labelFunc(subtree))
+    return stringsL[0]
 
 def writeTree(tree,fileName):
     '''Write tree to fileName (in newick format).'''
@@ -516,12 +560,7 @@ already (e.g. if confidence values have been put in the name field).'''
 def tupleTree2NoBrLenNewick(tree):
     '''Convert a four tuple based tree (root,left,right,branchLen) into a
 newick formated string, without branch lengths.'''
-    if tree[1]==():
-        return str(tree[0])
-    else:
-        leftStr=tupleTree2NoBrLenNewick(tree[1])
-        rightStr=tupleTree2NoBrLenNewick(tree[2])
-        return "("+leftStr+","+rightStr+")"+str(tree[0])
+    return newickString(tree,lambda subtree: "" if subtree[1]==() else str(subtree[0]))
 
 def writeTreeNoBrLen(tree,fileName):
     '''Write tree to fileName (in newick format).'''
@@ -537,12 +576,16 @@ def stripBranchLen(bpTree):
 
 def stripBranchLenTupleTree(tree):
     '''Remove branch lengths from tree.'''
-    if tree[1] == ():
-        return(tree[0],tree[1],tree[2],None)
-    else:
-        ltree = stripBranchLenTupleTree(tree[1])
-        rtree = stripBranchLenTupleTree(tree[2])
-        return(tree[0],ltree,rtree,None)
+    # as in bioPhyloCladeToTupleTree
+    subtreesL=[]
+    for tree in iterPostorder(tree):
+        if tree[1] == ():
+            subtreesL.append((tree[0],tree[1],tree[2],None))
+        else:
+            rtree = subtreesL.pop()
+            ltree = subtreesL.pop()
+            subtreesL.append((tree[0],ltree,rtree,None))
+    return subtreesL[0]
         
 def makeGeneFamilyTrees(paramD,genesO,familiesO,gtFileStem = 'fam'):
     '''Given a families object, create a gene tree for each family.'''
@@ -625,20 +668,23 @@ def createLocusMapForRootingD(geneTree,locusMapForRootingD):
     in the input (arbitrarily rooted) tree. If a loc can be assigned, we are not
     going to root on branches where both terminals are assigned loc
     """
-    if geneTree[0] in locusMapForRootingD:
-        return locusMapForRootingD
-    else:
+    # The nodes are handled in postorder, so left and right are handled
+    # before the current node. Nodes already in locusMapForRootingD
+    # aren't descended into.
+    def childFunc(geneTree):
+        if geneTree[0] in locusMapForRootingD:
+            return ()
+        return childSubtrees(geneTree)
+    for geneTree in iterPostorder(geneTree,childFunc):
+        if geneTree[0] in locusMapForRootingD:
+            continue
         # always an internal node since locusMapForRootingD starts w/tips
-        # recurse on left and right
-        locusMapForRootingD = createLocusMapForRootingD(geneTree[1],locusMapForRootingD)
-        locusMapForRootingD = createLocusMapForRootingD(geneTree[2],locusMapForRootingD)
-        # handle current node
-        if locusMapForRootingD[geneTree[1][0]] == locusMapForRootingD[geneTree[2][0]]:
+        elif locusMapForRootingD[geneTree[1][0]] == locusMapForRootingD[geneTree[2][0]]:
             locusMapForRootingD[geneTree[0]] = locusMapForRootingD[geneTree[1][0]]
         else:
             locusMapForRootingD[geneTree[0]] = "*"
 
-        return locusMapForRootingD
+    return locusMapForRootingD
 
 def left_subtree(tree):
     return tree[1]
@@ -660,10 +706,12 @@ def get_all_rerootings(tree,locusMapForRootingD):
     """
 
     def reroot_left(t):
+        """The two trees with the root moved down one edge into the left
+        subtree of t, or () if it cannot move."""
         root, left, right, _ = t
         lt_name, A, B , _= left
         if len(A) == 0: # cannot move root
-            return
+            return ()
 
         # create rerooted trees
         t1 = (root,
@@ -676,22 +724,15 @@ def get_all_rerootings(tree,locusMapForRootingD):
                     (lt_name, A, right, None),
                     None
              )
-
-        # add to rerooted trees
-        if validRooting(t1, locusMapForRootingD):
-            trees.append(t1)
-        if validRooting(t1, locusMapForRootingD):
-            trees.append(t2)
-
-        # recur to keep moving down left subtree
-        reroot_left(t1)
-        reroot_left(t2)
+        return (t1, t2)
 
     def reroot_right(t):
+        """The two trees with the root moved down one edge into the right
+        subtree of t, or () if it cannot move."""
         root, left, right, _ = t
         rt_name, C, D, _ = right
         if len(C) == 0: # cannot move root
-            return
+            return ()
 
         # create rerooted trees
         t1 = (root,
@@ -704,19 +745,29 @@ def get_all_rerootings(tree,locusMapForRootingD):
                    D,
                    None
              )
-        # add to rerooted trees
-        if validRooting(t1, locusMapForRootingD):
-            trees.append(t1)
-        if validRooting(t1, locusMapForRootingD):
-            trees.append(t2)
-
-        # recur to keep moving down right subtree
-        reroot_right(t1)
-        reroot_right(t2)
+        return (t1, t2)
+
+    def add_rerootings(t, reroot):
+        """Keep moving the root down from t with reroot, adding the
+        rerooted trees to trees. t1 and everything below it is added
+        before t2."""
+        stack = [t]
+        while stack:
+            moved = reroot(stack.pop())
+            if moved == ():
+                continue
+            t1, t2 = moved
+            # add to rerooted trees
+            if validRooting(t1, locusMapForRootingD):
+                trees.append(t1)
+            if validRooting(t1, locusMapForRootingD):
+                trees.append(t2)
+            stack.append(t2)
+            stack.append(t1)
 
     trees = [tree]
-    reroot_left(tree)
-    reroot_right(tree)
+    add_rerootings(tree, reroot_left)
+    add_rerootings(tree, reroot_right)
     return trees
 
 
@@ -729,55 +780,28 @@ def parseTreeForDP(tree, parasite):
             DTLOR_DP.py. Note, if an edge directs to a tip, the children 
             edges will be None
     """
-    def parseHelper(tree, treeDict):
-        """
-        Recursive helper. Note the edge to the root of 
-        the tree is already in treeDict
-        """
-        if tree[1]==(): pass  #can't be at a leaf
-        lt=tree[1]
-        rt=tree[2]
-        if lt[1]==(): # If left child is a leaf, add the edge to left child and stop
-            key=lt[0]
-            value=(tree[0],lt[0],None,None)
-            treeDict[key]=value
-        else: # If left child is not a leaf, add the edge to left child and recur on lt
-            key=lt[0]
-            # The left child of left tree
-            lt_lt=lt[1]
-            rt_lt=lt[2]
-            value=(tree[0],lt[0],lt_lt[0],rt_lt[0])
-            treeDict[key]=value
-            treeDict=parseHelper(lt,treeDict)
-        if rt[1]==(): # If right child is a leaf, add the edge to right child and stop
-            key=rt[0]
-            value=(tree[0],rt[0],None,None)
-            treeDict[key]=value
-        else: # If right child is not a leaf, add the edge to right child and recur on lt
-            key=rt[0]
-            lt_rt=rt[1]
-            rt_rt=rt[2]
-            value=(tree[0],rt[0],lt_rt[0],rt_rt[0])
-            treeDict[key]=value
-            treeDict=parseHelper(rt,treeDict)
-
-        return treeDict
-
-
     if tree[1]==(): # This tree cannot be only a root
         return None
 
     parsedTree = OrderedDict()
-    
-    lt=tree[1]
-    rt=tree[2]
-    if parasite:
+
+    # The edges are added in preorder. Each entry is
+    # a subtree and the name of the start vertex of the edge to it
     # (start vertex, end vertex, left child edge name, right child edge name)
-        value=("p_root", tree[0], lt[0], rt[0])
-        key = tree[0]
+    if parasite:
+        stack = [(tree, "p_root")]
     else:
-        value=("h_root", tree[0], lt[0], rt[0])
-        key = tree[0]
-    parsedTree[key] = value
-    
-    return parseHelper(tree, parsedTree)
+        stack = [(tree, "h_root")]
+    while stack:
+        subtree, top = stack.pop()
+        lt = subtree[1]
+        rt = subtree[2]
+        key = subtree[0]
+        if lt==(): # If this is a leaf, add the edge to it and stop
+            parsedTree[key] = (top, key, None, None)
+        else:
+            parsedTree[key] = (top, key, lt[0], rt[0])
+            stack.append((rt, key))
+            stack.append((lt, key))
+
+    return parsedTree